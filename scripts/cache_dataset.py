@@ -26,26 +26,35 @@ def main(args: RayCachedLMDatasetConfig):
 
     wandb.init(mode="offline")
 
-    for split in args.splits:
-        print(f"Caching {split} to {args.cache_dir}.")
-
-        # connect or start the actor
-        batch_tokenizer = BatchTokenizer(tokenizer)
-        split_cache_dir = os.path.join(args.cache_dir, split)
-        source = args.get_shard_source(split)
-        cache = cache_dataset(
-            cache_dir=split_cache_dir,
-            input_shards=source,
-            processor=batch_tokenizer,
-            rows_per_chunk=args.rows_per_chunk,
-            await_finished=False,
-        )
-
-        cache.attach_metrics_monitor(RichMetricsMonitor(source.num_shards))
-        cache.attach_metrics_monitor(WandbMetricsMonitor("preprocess/" + split, commit=True))
-
-        cache.await_finished()
-        print(f"Finished caching {split} to {split_cache_dir}.")
+    # start all the splits before waiting on any of them, so that the splits' shards share the cluster rather than
+    # each split waiting for the last one's stragglers. Rich can only show one live display at a time, so the splits
+    # share one Progress, with a task each
+    progress = RichMetricsMonitor.make_progress()
+
+    with progress:
+        caches = {}
+        for split in args.splits:
+            print(f"Caching {split} to {args.cache_dir}.")
+
+            # connect or start the actor
+            batch_tokenizer = BatchTokenizer(tokenizer)
+            split_cache_dir = os.path.join(args.cache_dir, split)
+            source = args.get_shard_source(split)
+            cache = cache_dataset(
+                cache_dir=split_cache_dir,
+                input_shards=source,
+                processor=batch_tokenizer,
+                rows_per_chunk=args.rows_per_chunk,
+                await_finished=False,
+            )
+
+            cache.attach_metrics_monitor(RichMetricsMonitor(source.num_shards, progress=progress, description=split))
+            cache.attach_metrics_monitor(WandbMetricsMonitor("preprocess/" + split, commit=True))
+            caches[split] = (cache, split_cache_dir)
+
+        for split, (cache, split_cache_dir) in caches.items():
+            cache.await_finished()
+            print(f"Finished caching {split} to {split_cache_dir}.")
 
 
 if __name__ == "__main__":
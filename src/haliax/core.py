@@ -228,8 +228,8 @@ class NamedArray:
     def slice(self, axis: AxisSelector, new_axis: Axis, start: int = 0) -> "NamedArray":
         return haliax.slice(self, axis=axis, new_axis=new_axis, start=start)
 
-    def take(self, axis: AxisSelector, index: Union[int, "NamedArray"]) -> "NamedArray":
-        return haliax.take(self, axis=axis, index=index)
+    def take(self, axis: AxisSelector, index: Union[int, "NamedArray"], *, mode: Optional[str] = None) -> "NamedArray":
+        return haliax.take(self, axis=axis, index=index, mode=mode)
 
     # np.ndarray methods:
     def all(self, axis: Optional[AxisSelection] = None) -> "NamedArray":
@@ -522,21 +522,26 @@ class NamedArray:
         return float(self.array)
 
 
-def take(array: NamedArray, axis: AxisSelector, index: Union[int, NamedArray]) -> NamedArray:
+def take(
+    array: NamedArray, axis: AxisSelector, index: Union[int, NamedArray], *, mode: Optional[str] = None
+) -> NamedArray:
     """
     Selects elements from an array along an axis, by an index or by another named array
 
     if index is a NamedArray, then those axes are added to the output array
+
+    `mode` is passed to jnp.take. The default ("fill") adds a select to handle out-of-bounds indices. "clip" maps
+    directly onto XLA's gather, which clamps indices anyway, so it's cheaper when the indices are known to be valid.
     """
     axis_index = array._lookup_indices(axis)
     if axis_index is None:
         raise ValueError(f"axis {axis} not found in {array}")
     if isinstance(index, int):
         # just drop the axis
-        new_array = jnp.take(array.array, index, axis=axis_index)
+        new_array = jnp.take(array.array, index, axis=axis_index, mode=mode)
         new_axes = array.axes[:axis_index] + array.axes[axis_index + 1 :]
     else:
-        new_array = jnp.take(array.array, index.array, axis=axis_index)
+        new_array = jnp.take(array.array, index.array, axis=axis_index, mode=mode)
         new_axes = array.axes[:axis_index] + index.axes + array.axes[axis_index + 1 :]
     # new axes come from splicing the old axis with
     return NamedArray(new_array, new_axes)
@@ -557,10 +562,14 @@ def slice(array: NamedArray, axis: AxisSelector, new_axis: Axis, start: int = 0)
     return NamedArray(sliced, new_axes)
 
 
-def dot(axis: AxisSelection, *arrays: NamedArray, precision: PrecisionLike = None) -> NamedArray:
+def dot(
+    axis: AxisSelection, *arrays: NamedArray, precision: PrecisionLike = None, preferred_element_type=None
+) -> NamedArray:
     """Returns the tensor product of two NamedArrays. The axes `axis` are contracted over,
     and any other axes that are shared between the arrays are batched over. Non-contracted Axes in one
     that are not in the other are preserved.
+
+    `preferred_element_type` is the accumulation/output dtype, e.g. jnp.int32 for int8 inputs.
     """
     axis = ensure_tuple(axis)
 
@@ -589,6 +598,7 @@ def dot(axis: AxisSelection, *arrays: NamedArray, precision: PrecisionLike = Non
         ", ".join(array_specs) + "-> " + output_spec,
         *[a.array for a in arrays],
         precision=precision,
+        preferred_element_type=preferred_element_type,
     )
 
     return NamedArray(output, output_axes)
@@ -686,9 +696,10 @@ def unbind(array: NamedArray, axis: AxisSelector) -> List[NamedArray]:
     new_axes = array.axes[:axis_index] + array.axes[axis_index + 1 :]
     # this implementation maybe triggers an all-gather in pjit so no good
     # arrays = jnp.rollaxis(array.array, axis=axis_index, start=0)
-    # instead we just loop over the axes pulling one out at a time
+    # instead we just loop over the axes pulling one out at a time. We use static slices rather than jnp.take, which
+    # lowers to a gather (plus an out-of-bounds select) that XLA won't always fuse into its producer
     axis_size = array.axes[axis_index].size
-    arrays = [jnp.take(array.array, i, axis=axis_index) for i in range(axis_size)]
+    arrays = [jax.lax.index_in_dim(array.array, i, axis=axis_index, keepdims=False) for i in range(axis_size)]
     from haliax.partitioning import auto_sharded
 
     return [auto_sharded(NamedArray(a, new_axes)) for a in arrays]
@@ -13,7 +13,7 @@ from ..types import Axis, AxisSelector, AxisSpec
 from ..wrap import unwrap_namedarrays, wrap_axiswise_call, wrap_elemwise_unary, wrap_reduction_call
 from .dropout import Dropout
 from .embedding import Embedding
-from .linear import Linear
+from .linear import Linear, QuantizedLinear
 from .normalization import LayerNorm
 from .scan import Stacked
 
@@ -44,7 +44,6 @@ def glu(x: NamedArray, axis: Axis) -> NamedArray:
 
 logsumexp = wrap_reduction_call(jnn.logsumexp, False, supports_where=False)
 
-# TODO: support where in softmax, etc
 softmax = wrap_axiswise_call(jnn.softmax, False)
 log_softmax = wrap_axiswise_call(jnn.log_softmax, False)
 
@@ -144,6 +143,7 @@ __all__ = [
     "Dropout",
     "LayerNorm",
     "Linear",
+    "QuantizedLinear",
     "Embedding",
     "Stacked",
 ]
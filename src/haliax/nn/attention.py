@@ -1,5 +1,5 @@
 import math
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import jax
 import jax.numpy as jnp
@@ -8,7 +8,7 @@ from jax.random import PRNGKey
 
 import haliax
 import haliax.random as hrandom
-from haliax.core import NamedArray
+from haliax.core import NamedArray, selects_axis
 from haliax.types import Axis, AxisSelection, AxisSpec, PrecisionLike
 
 
@@ -112,6 +112,197 @@ def dot_product_attention(
     return haliax.dot(KPos, weights, value)
 
 
+def flash_attention(
+    QPos: Axis,
+    KPos: Axis,
+    KeySize: Axis,
+    query: NamedArray,
+    key: NamedArray,
+    value: NamedArray,
+    mask: Optional[NamedArray] = None,
+    bias: Optional[NamedArray] = None,
+    *,
+    causal: bool = False,
+    block_size: int = 128,
+    accumulator_dtype: jnp.dtype = jnp.float32,
+    precision: PrecisionLike = None,
+) -> NamedArray:
+    """
+    Blockwise ("flash") attention. Computes the same thing as [dot_product_attention][], but iterates over blocks of
+    the key sequence with an online softmax, so that the full (QPos, KPos) attention matrix is never materialized.
+    In the forward pass only one (QPos, block_size) tile of scores is live at a time, and the running max,
+    denominator, and output are accumulated in `accumulator_dtype`. The backward pass is a custom vjp that saves only
+    the inputs, the output, and the softmax max and denominator of each row, and recomputes each block's scores from those, so the
+    memory for the backward pass is also linear in the sequence length.
+
+    Unlike dot_product_attention, this does *not* scale the query: callers should do that themselves (which lets them
+    use e.g. a per-layer scale). Dropout on the attention weights is not supported. The mask isn't differentiated.
+
+    :param QPos: Axis of query sequence length
+    :param KPos: Axis of key sequence length. Must be distinct from QPos.
+    :param KeySize: Axis of head dimension
+    :param query: NamedArray of shape (QPos, KeySize)
+    :param key: NamedArray of shape (KPos, KeySize)
+    :param value: NamedArray of shape (KPos, KeySize)
+    :param mask: Optional[NamedArray] broadcast compatible with (KeySize, QPos, KPos). Should be boolean
+    :param bias: Optional[NamedArray] broadcast compatible with (KeySize, QPos, KPos). Should be float
+    :param causal: If True, apply a causal mask. It is computed per block rather than passed in as a full mask.
+    :param block_size: Size of the key blocks. If it doesn't divide KPos.size, the keys are padded (and the padding
+        masked out) to a multiple of it.
+    :param accumulator_dtype: dtype used for the scores and the softmax statistics
+    :param precision: PrecisionLike for dot product. See precision argument to jax.lax.dot_general
+    :return: NamedArray of shape (QPos, KeySize)
+    """
+    if KPos.name == QPos.name:
+        raise ValueError("QPos and KPos must have different names for flash_attention")
+
+    block_size = min(block_size, KPos.size)
+    num_blocks = -(-KPos.size // block_size)
+    padding = num_blocks * block_size - KPos.size
+
+    KBlock = Axis(f"{KPos.name}_block", num_blocks)
+    KBlockPos = Axis(KPos.name, block_size)
+
+    def _blocked(x: Optional[NamedArray]) -> Optional[NamedArray]:
+        if x is None or not selects_axis(x.axes, KPos.name):
+            return x
+        if padding:
+            x = _pad_axis(x, KPos.name, padding)
+        return haliax.unflatten_axis(x, KPos.name, (KBlock, KBlockPos))
+
+    def _unblocked(x: NamedArray, like: NamedArray) -> NamedArray:
+        """Undoes _blocked for a gradient that haliax.scan stacked along KBlock, in the axis order of `like`"""
+        if not selects_axis(like.axes, KPos.name):
+            # `like` was passed whole to every block, so each block contributed a term to its gradient
+            return haliax.sum(x, axis=KBlock).rearrange(like.axes)
+        x = haliax.flatten_axes(x, (KBlock, KBlockPos), Axis(KPos.name, num_blocks * block_size))
+        if padding:
+            x = haliax.slice(x, KPos.name, KPos)
+        return x.rearrange(like.axes)
+
+    # the softmax statistics are over the query axes (minus KeySize), the output additionally has value's KeySize
+    Rows = tuple(ax for ax in query.axes if ax.name != KeySize.name)
+    OutAxes = Rows + (value.resolve_axis(KeySize.name),)
+
+    # (the custom vjp's functions can't close over traced values, so everything they use is passed in or made inside)
+    def _block_scores(query, k_blk, mask_blk, bias_blk, blk_idx):
+        scores = haliax.dot(KeySize, query, k_blk, precision=precision).astype(accumulator_dtype)
+
+        if bias_blk is not None:
+            scores = scores + bias_blk
+        k_pos = haliax.arange(KBlockPos) + blk_idx * block_size
+        if causal:
+            q_pos = haliax.arange(QPos)
+            scores = haliax.where(q_pos.broadcast_axis(KBlockPos) >= k_pos.broadcast_axis(QPos), scores, -1e9)
+        if mask_blk is not None:
+            scores = haliax.where(mask_blk, scores, -1e9)
+        # this has to come last, and be below the mask value: a row that's entirely masked should still be a uniform
+        # average of just the real keys, as it is in dot_product_attention
+        if padding:
+            scores = haliax.where(k_pos < KPos.size, scores, -jnp.inf)
+
+        return scores
+
+    def _forward(query, key, value, mask, bias):
+        def _attend_block(carry, k_blk, v_blk, mask_blk, bias_blk, blk_idx):
+            acc, running_max, denom = carry
+
+            scores = _block_scores(query, k_blk, mask_blk, bias_blk, blk_idx)
+
+            new_max = haliax.maximum(running_max, haliax.max(scores, axis=KBlockPos)).rearrange(Rows)
+            correction = haliax.exp(running_max - new_max)
+            p = haliax.exp(scores - new_max)
+
+            denom = (denom * correction + haliax.sum(p, axis=KBlockPos)).rearrange(Rows)
+            pv = haliax.dot(KBlockPos, p.astype(v_blk.dtype), v_blk, precision=precision)
+            acc = (acc * correction + pv.astype(accumulator_dtype)).rearrange(OutAxes)
+
+            return acc, new_max, denom
+
+        init = (
+            haliax.zeros(OutAxes, dtype=accumulator_dtype),
+            haliax.full(Rows, -jnp.inf, dtype=accumulator_dtype),
+            haliax.zeros(Rows, dtype=accumulator_dtype),
+        )
+
+        acc, running_max, denom = haliax.fold(_attend_block, KBlock)(
+            init, _blocked(key), _blocked(value), _blocked(mask), _blocked(bias), haliax.arange(KBlock)
+        )
+
+        return (acc / denom).astype(value.dtype), running_max, denom
+
+    @jax.custom_vjp
+    def _attention(query, key, value, mask, bias):
+        return _forward(query, key, value, mask, bias)[0]
+
+    def _attention_fwd(query, key, value, mask, bias):
+        # the max and denominator are kept apart rather than as a logsumexp: for a row that's entirely masked, the max is
+        # -1e9 and adding log(denom) to it would round away
+        out, row_max, denom = _forward(query, key, value, mask, bias)
+        return out, (query, key, value, mask, bias, out, row_max, denom)
+
+    def _attention_bwd(residuals, grad_out):
+        query, key, value, mask, bias, out, row_max, denom = residuals
+
+        # sum_k p_qk * grad_p_qk, which is the same as the rowwise dot of the output with its gradient
+        delta = haliax.dot(KeySize.name, grad_out.astype(accumulator_dtype), out.astype(accumulator_dtype))
+
+        def _backward_block(grad_q, k_blk, v_blk, mask_blk, bias_blk, blk_idx):
+            # differentiating the scores themselves takes care of the masking and of broadcasting the bias
+            scores, scores_vjp = jax.vjp(
+                lambda q, k, b: _block_scores(q, k, mask_blk, b, blk_idx), query, k_blk, bias_blk
+            )
+            p = haliax.exp(scores - row_max) / denom
+
+            grad_v = haliax.dot(QPos, p.astype(grad_out.dtype), grad_out, precision=precision)
+            grad_p = haliax.dot(KeySize.name, grad_out, v_blk, precision=precision).astype(accumulator_dtype)
+            grad_q_blk, grad_k, grad_bias = scores_vjp(p * (grad_p - delta))
+
+            return grad_q + grad_q_blk.astype(accumulator_dtype), (grad_k, _sum_to(grad_v, v_blk.axes), grad_bias)
+
+        grad_q, (grad_k, grad_v, grad_bias) = haliax.scan(_backward_block, KBlock)(
+            haliax.zeros(query.axes, dtype=accumulator_dtype),
+            _blocked(key),
+            _blocked(value),
+            _blocked(mask),
+            _blocked(bias),
+            haliax.arange(KBlock),
+        )
+
+        if bias is not None:
+            grad_bias = _unblocked(grad_bias, bias).astype(bias.dtype)
+
+        return (
+            grad_q.astype(query.dtype),
+            _unblocked(grad_k, key).astype(key.dtype),
+            _unblocked(grad_v, value).astype(value.dtype),
+            None,
+            grad_bias,
+        )
+
+    _attention.defvjp(_attention_fwd, _attention_bwd)
+
+    return _attention(query, key, value, mask, bias)
+
+
+def _pad_axis(x: NamedArray, axis: str, amount: int) -> NamedArray:
+    """Pads the end of `axis` with `amount` zeros (False for boolean arrays)"""
+    index = x._lookup_indices(axis)
+    pad_width = [(0, 0)] * x.ndim
+    pad_width[index] = (0, amount)
+    new_axes = tuple(Axis(ax.name, ax.size + amount) if i == index else ax for i, ax in enumerate(x.axes))
+    return NamedArray(jnp.pad(x.array, pad_width), new_axes)
+
+
+def _sum_to(x: NamedArray, axes: Tuple[Axis, ...]) -> NamedArray:
+    """Sums out the axes of x that aren't in `axes` (i.e. undoes broadcasting) and orders the rest like `axes`"""
+    names = {ax.name for ax in axes}
+    extra = tuple(ax for ax in x.axes if ax.name not in names)
+    if extra:
+        x = haliax.sum(x, axis=extra)
+    return x.rearrange(axes)
+
+
 def mask_to_bias(mask: NamedArray, mask_value: float = -1e9) -> NamedArray:
     return mask * mask_value
 
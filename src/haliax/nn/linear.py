@@ -2,6 +2,7 @@ from typing import Optional
 
 import equinox as eqx
 import jax
+import jax.numpy as jnp
 
 import haliax as hax
 
@@ -36,3 +37,42 @@ class Linear(eqx.Module):
             q = hax.auto_sharded(q)
 
         return q
+
+
+class QuantizedLinear(eqx.Module):
+    """An int8 version of [Linear][] for inference. Weights are stored as int8 with one f32 scale per output channel.
+    Inputs are quantized on the fly with one scale per row (i.e. per everything-but-In), so the matmul itself runs
+    int8 x int8 -> int32."""
+
+    weight: NamedArray  # int8
+    scale: NamedArray  # per output channel, so has the Out axes
+    bias: Optional[NamedArray]
+
+    In: AxisSpec = eqx.static_field()
+    Out: AxisSpec = eqx.static_field()
+
+    @staticmethod
+    def from_linear(linear: Linear) -> "QuantizedLinear":
+        weight, scale = _quantize_int8(linear.weight, linear.In)
+        return QuantizedLinear(weight, scale, linear.bias, linear.In, linear.Out)
+
+    @jax.named_scope(name="quantized_linear")
+    def __call__(self, inputs):
+        q_inputs, input_scale = _quantize_int8(inputs, self.In)
+        q = hax.dot(self.In, q_inputs, self.weight, preferred_element_type=jnp.int32)
+        q = (q.astype(jnp.float32) * input_scale * self.scale).astype(inputs.dtype)
+        q = hax.auto_sharded(q)
+
+        if self.bias is not None:
+            q = q + self.bias
+            q = hax.auto_sharded(q)
+
+        return q
+
+
+def _quantize_int8(x: NamedArray, axis: AxisSpec):
+    """Symmetric absmax quantization to int8, with one scale per slice along `axis`"""
+    absmax = hax.max(hax.abs(x.astype(jnp.float32)), axis=axis)
+    scale = hax.maximum(absmax, 1e-8) / 127.0
+    q = hax.clip(hax.round(x / scale), -127, 127).astype(jnp.int8)
+    return q, scale
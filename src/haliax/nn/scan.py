@@ -1,11 +1,13 @@
 import functools
-from typing import Dict, Generic, Optional, Protocol, Type, TypeVar
+from typing import Callable, Dict, Generic, Optional, Protocol, Type, TypeVar
 
 import equinox as eqx
+import jax
 
 import haliax
-from haliax.core import Axis
-from haliax.jax_utils import filter_checkpoint
+from haliax.core import Axis, selects_axis
+from haliax.jax_utils import filter_checkpoint, is_jax_array_like
+from haliax.util import is_named_array
 
 
 M = TypeVar("M", bound=eqx.Module, covariant=True)
@@ -36,6 +38,13 @@ class Stacked(eqx.Module, Generic[M]):
     output, while "scan" is the same as a for loop that accumulates a list of intermediates as well as the final output.
 
     Stacked also supports gradient checkpointing, which is useful for very large models that don't fit in memory.
+    By default every block is checkpointed, which means the input to every block is saved for the backward pass.
+    If `checkpoint_block_size` is set, the blocks are instead grouped into chunks of that size and checkpointed
+    at two levels: only the inputs to each chunk are saved, and the per-block inputs of a chunk are recomputed
+    during its backward pass. With a block size of sqrt(num_blocks) this stores O(sqrt(num_blocks)) activations
+    instead of O(num_blocks), at the cost of one extra forward pass.
+    `checkpoint_policy` is passed to jax.checkpoint for each block (e.g. jax.checkpoint_policies.dots_saveable),
+    to save some intermediates (like matmul outputs) rather than recomputing the whole block.
 
     Example:
         >>> import equinox as eqx
@@ -58,33 +67,102 @@ class Stacked(eqx.Module, Generic[M]):
 
     stacked: M
     Block: Axis = eqx.static_field()
-    # TODO: support fancier gradient checkpointing
     gradient_checkpointing: bool = eqx.static_field()
+    checkpoint_block_size: Optional[int] = eqx.static_field(default=None)
+    checkpoint_policy: Optional[Callable[..., bool]] = eqx.static_field(default=None)
 
     @staticmethod
-    def init(Block: Axis, module: Type[M], *, gradient_checkpointing: bool = False) -> ModuleInit["Stacked[M]"]:
+    def init(
+        Block: Axis,
+        module: Type[M],
+        *,
+        gradient_checkpointing: bool = False,
+        checkpoint_block_size: Optional[int] = None,
+        checkpoint_policy: Optional[Callable[..., bool]] = None,
+    ) -> ModuleInit["Stacked[M]"]:
         @functools.wraps(module)
         def fn(*args, **kwargs):
             stacked = haliax.vmap(module.init, Block)(*args, **kwargs)
-            return Stacked(stacked, Block, gradient_checkpointing)
+            return Stacked(stacked, Block, gradient_checkpointing, checkpoint_block_size, checkpoint_policy)
 
         return fn
 
     def scan(self, init, *extra_args, **extra_kwargs):
+        if self._nested_block_size() is not None:
+            return self._nested(haliax.scan, init, *extra_args, **extra_kwargs)
+
         if self.gradient_checkpointing:
-            do_block = filter_checkpoint(self._do_block)
+            do_block = filter_checkpoint(self._do_block, policy=self.checkpoint_policy)
         else:
             do_block = self._do_block
         return haliax.scan(do_block, self.Block)(init, self.stacked, *extra_args, **extra_kwargs)
 
     def fold(self, init, *args, **kwargs):
+        if self._nested_block_size() is not None:
+            return self._nested(haliax.fold, init, *args, **kwargs)
+
         if self.gradient_checkpointing:
-            do_block = filter_checkpoint(self._do_block)
+            do_block = filter_checkpoint(self._do_block, policy=self.checkpoint_policy)
         else:
             do_block = self._do_block
 
         return haliax.fold(do_block, self.Block)(init, self.stacked, *args, **kwargs)
 
+    def _nested_block_size(self) -> Optional[int]:
+        """The size of the inner chunks for two-level checkpointing, or None if we just checkpoint every block"""
+        if not self.gradient_checkpointing or self.checkpoint_block_size is None:
+            return None
+
+        # use the largest block size that evenly divides the number of blocks
+        block_size = min(self.checkpoint_block_size, self.Block.size)
+        while self.Block.size % block_size != 0:
+            block_size -= 1
+
+        if block_size <= 1 or block_size >= self.Block.size:
+            return None
+
+        return block_size
+
+    def _nested(self, loop, init, *args, **kwargs):
+        """Two-level checkpointed version of fold/scan, where `loop` is haliax.fold or haliax.scan"""
+        block_size = self._nested_block_size()
+        assert block_size is not None
+        Inner = Axis(self.Block.name, block_size)
+        Outer = Axis(f"{self.Block.name}_outer", self.Block.size // block_size)
+
+        def split(x):
+            if is_named_array(x):
+                if selects_axis(x.axes, self.Block.name):
+                    return x.unflatten_axis(self.Block.name, (Outer, Inner))
+                return x
+            elif is_jax_array_like(x):
+                return x.reshape((Outer.size, Inner.size) + x.shape[1:])
+            return x
+
+        def merge(y):
+            if is_named_array(y):
+                y = y.flatten_axes((Outer, Inner), self.Block)
+                return y.rearrange((self.Block,) + tuple(ax for ax in y.axes if ax != self.Block))
+            elif is_jax_array_like(y):
+                return y.reshape((self.Block.size,) + y.shape[2:])
+            return y
+
+        do_block = filter_checkpoint(self._do_block, policy=self.checkpoint_policy)
+
+        # the chunk-level checkpoint saves nothing but its inputs, regardless of the policy
+        @filter_checkpoint
+        def do_chunk(carry, chunk, *extra_args, **extra_kwargs):
+            return loop(do_block, Inner)(carry, chunk, *extra_args, **extra_kwargs)
+
+        stacked, args, kwargs = jax.tree_util.tree_map(split, (self.stacked, args, kwargs), is_leaf=is_named_array)
+        out = loop(do_chunk, Outer)(init, stacked, *args, **kwargs)
+
+        if loop is haliax.fold:
+            return out
+
+        carry, ys = out
+        return carry, jax.tree_util.tree_map(merge, ys, is_leaf=is_named_array)
+
     @staticmethod
     def _do_block(carry, block, *extra_args, **extra_kwargs):
         return block(carry, *extra_args, **extra_kwargs)
@@ -264,7 +264,6 @@ def named_jit(
 
         static = (static_fun, static_argspec)
 
-        output_shape = _cached_filter_eval_shape(fn, *args, **kwargs)
         # TODO: with new jax.Array I shouldn't have to specify shardings, but I do for now
         #  https://github.com/google/jax/issues/15600
         # we don't really need in_shardings though
@@ -280,7 +279,7 @@ def named_jit(
             my_pjit_args["in_shardings"] = in_resources
 
         if out_axis_resources is not None:
-            out_resources = infer_resource_partitions(output_shape, out_axis_resources)
+            out_resources = _cached_out_shardings(static, out_axis_resources, fn, *args, **kwargs)
             my_pjit_args["out_shardings"] = out_resources
 
         if axis_resources is not None:
@@ -345,6 +344,27 @@ def _cached_filter_eval_shape(fun, *args, **kwargs):
     return _eval_shape_cache[static]
 
 
+_out_shardings_cache = {}
+
+
+def _cached_out_shardings(static, out_axis_resources: ResourceMapping, fun, *args, **kwargs):
+    """
+    The output shardings of a named_jit'd function only depend on its static arguments, the resource mapping, and the
+    mesh, so we cache them too. Otherwise we'd walk the whole output tree (often the model and optimizer state) on
+    every call.
+    """
+    mapping_key = tuple(
+        (name, spec if spec is None or isinstance(spec, str) else tuple(spec))
+        for name, spec in out_axis_resources.items()
+    )
+    key = (static, mapping_key, _get_mesh())
+    if key not in _out_shardings_cache:
+        output_shape = _cached_filter_eval_shape(fun, *args, **kwargs)
+        _out_shardings_cache[key] = infer_resource_partitions(output_shape, out_axis_resources)
+
+    return _out_shardings_cache[key]
+
+
 def physical_axis_name(axis: AxisSelector, mapping: Optional[ResourceMapping] = None) -> Optional[PhysicalAxisSpec]:
     """Get the physical axis name for a logical axis from the mapping. Returns none if the axis is not mapped."""
     mapping = mapping or _mapping_holder.thread_data.resource_mapping
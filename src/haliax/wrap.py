@@ -88,6 +88,10 @@ def wrap_axiswise_call(fn, single_axis_only: bool):
     @functools.wraps(fn)
     def wrapper(a, axis: Optional[AxisSelection] = None, **kwargs):
         if isinstance(a, NamedArray):
+            where = kwargs.get("where", None)
+            if isinstance(where, NamedArray):
+                kwargs["where"] = broadcast_to(where, a.axes).array
+
             if axis is None:
                 return NamedArray(fn(a.array, axis=None, **kwargs), a.axes)
             else:
@@ -107,7 +111,7 @@ def wrap_axiswise_call(fn, single_axis_only: bool):
     wrapper.__doc__ = (
         """
     This function augments the behavior of `{fn}` to support NamedArrays, so that axis is an Axis of sequence of axes.
-    At the moment, neither `where` nor `out` are supported.
+    `where` may be a NamedArray, which is broadcast to the input's axes. `out` is not supported.
     =====
 
     """
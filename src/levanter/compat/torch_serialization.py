@@ -178,6 +178,10 @@ def unstack_state_dict(state_dict: StateDict, prefix: Optional[str] = None) -> S
 
     for k, v in state_dict.items():
         if k.startswith(prefix):
+            # iterating over a numpy array yields views, so this doesn't copy. (Iterating over a jax array would
+            # dispatch one slice op per layer, so we pull the stacked array to host once instead.)
+            if not isinstance(v, numpy.ndarray):
+                v = numpy.asarray(v)
             for i, v_i in enumerate(v):
                 new_dict[f"{prefix}{i}.{k[len(prefix):]}"] = v_i
         else:
@@ -199,12 +203,16 @@ def stack_state_dict(state_dict: StateDict, prefix: Optional[str] = None) -> Sta
     """
     vectorized_dict: StateDict = {}
 
+    # we group the per-layer tensors by key in a single pass, then do one stack (one allocation and copy) per key
     tensors_to_vectorize: Dict[str, List[Optional[Any]]] = {}
     escaped = re.escape(prefix or "")
     pattern = re.compile(rf"{escaped}\.(\d+)\.(.*)")
+    key_start = f"{prefix}." if prefix else "."
 
     for k, v in state_dict.items():
-        match = pattern.match(k)
+        # cheap check before the regex, since most keys in a large state dict are per-layer ones we want or
+        # top-level ones we don't
+        match = pattern.match(k) if k.startswith(key_start) else None
         if match:
             block_idx = int(match.group(1))
             block_key = match.group(2)
@@ -218,6 +226,9 @@ def stack_state_dict(state_dict: StateDict, prefix: Optional[str] = None) -> Sta
 
     # now we have to vectorize the tensors
     for k, tensors in tensors_to_vectorize.items():
+        missing = [i for i, t in enumerate(tensors) if t is None]
+        if missing:
+            raise ValueError(f"Missing layers {missing} for key {apply_prefix(prefix, k)}")
         vectorized_dict[cast(str, apply_prefix(prefix, k))] = numpy.stack(tensors, axis=0)
 
     return vectorized_dict
@@ -1,13 +1,15 @@
 # Dataset for preprocessing data, tokenizing, and caching to disk.
 import asyncio
+import collections
 import dataclasses
+import itertools
 import logging
 import os
 import sys
 import threading
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Dict, Generic, Iterable, Iterator, List, Optional, Protocol, Sequence, Tuple, TypeVar
+from typing import Deque, Dict, Generic, Iterable, Iterator, List, Optional, Protocol, Sequence, Tuple, TypeVar
 
 import fsspec.core
 import pyarrow as pa
@@ -20,12 +22,14 @@ from ray.actor import ActorHandle
 from rich.progress import (
     BarColumn,
     Progress,
+    ProgressColumn,
     TaskID,
     TaskProgressColumn,
     TextColumn,
     TimeElapsedColumn,
     TimeRemainingColumn,
 )
+from rich.text import Text
 
 import wandb
 
@@ -38,6 +42,9 @@ _ExcInfo = Tuple[Optional[BaseException], tblib.Traceback]
 logger = logging.getLogger(__name__)
 
 DEFAULT_ROWS_PER_CHUNK = 1024 * 32
+MAX_CHUNKS_IN_FLIGHT_PER_SHARD = 2
+# with LEVANTER_INPROC_CACHE=1, sources with at most this many rows are cached without ray. See cache_dataset
+IN_PROCESS_CACHE_MAX_ROWS = 1024
 LEDGER_FILE_NAME = "cache_ledger.json"
 
 
@@ -84,6 +91,14 @@ def cache_dataset(
     rows_per_chunk: int = DEFAULT_ROWS_PER_CHUNK,
     await_finished: bool = True,
 ) -> "ShardCache":
+    # small datasets (e.g. in tests) are cheaper to build right here than to round-trip through ray. This is opt-in
+    # (LEVANTER_INPROC_CACHE=1), since it reads the start of the source in this process to find out if it's small,
+    # and processors that need gpus or custom resources still go through ray to get them
+    if _in_process_cache_enabled() and _can_process_in_process(processor) and not _ledger_exists(cache_dir):
+        shard_rows = _read_small_source(input_shards, IN_PROCESS_CACHE_MAX_ROWS)
+        if shard_rows is not None:
+            _build_cache_in_process(cache_dir, shard_rows, processor, rows_per_chunk)
+
     # first see if we need to do anything
     cache = ShardCache(cache_dir, input_shards, processor, batch_size, rows_per_chunk)
 
@@ -121,21 +136,23 @@ class CacheLedger:
     chunks: List[ChunkMetadata] = dataclasses.field(default_factory=list)
 
 
-def _mk_process_task(processor: BatchProcessor[T]):
+def _mk_produce_chunk_task(processor: BatchProcessor[T]):
+    # processing and writing happen in the same task, so the processed record batch goes straight to disk instead of
+    # making a round trip through the object store to a separate writer task
     @ray.remote(num_cpus=processor.num_cpus, num_gpus=processor.num_gpus, resources=processor.resources)
-    def process_task(batch: List[T]) -> pa.RecordBatch:
-        return processor(batch)
+    def produce_chunk(batch: List[T], cache_dir: str, chunk_name: str) -> ChunkMetadata:
+        return _write_chunk(processor(batch), cache_dir, chunk_name)
 
-    return process_task
+    return produce_chunk
 
 
-@ray.remote(num_cpus=0)
-def _produce_chunk(batch: List[T], processor: BatchProcessor[T], cache_dir: str, chunk_name: str) -> ChunkMetadata:
-    process_task = _mk_process_task(processor)
-    record_batch = ray.get(process_task.remote(batch))
+def _write_chunk(record_batch: pa.RecordBatch, cache_dir: str, chunk_name: str) -> ChunkMetadata:
     logger.debug(f"Produced chunk {chunk_name} with {record_batch.num_rows} rows. Writing to {cache_dir}/{chunk_name}")
     with fsspec.open(os.path.join(cache_dir, f"{chunk_name}.parquet"), "wb") as file:
-        with pq.ParquetWriter(file, record_batch.schema, version="2.6", compression="ZSTD") as writer:
+        # token columns are flat uint16/int32 buffers (see _as_record_batch), which compress well at zstd level 1
+        with pq.ParquetWriter(
+            file, record_batch.schema, version="2.6", compression="ZSTD", compression_level=1
+        ) as writer:
             writer.write_batch(record_batch)
 
         field_counts = {}
@@ -192,24 +209,33 @@ def _produce_cache_for_shard(
 
         if not was_finished:
             count = len(shard_metadata.chunks)
+            # chunks that have been submitted but not yet yielded, in order. Keeping a few in flight lets us read
+            # and process the next chunk while the previous one is being written, while the bound gives us
+            # backpressure so we don't starve other shards (which we want to stream round-robin)
+            in_flight: Deque[ray.ObjectRef] = collections.deque()
+            produce_chunk = _mk_produce_chunk_task(processor)
             batch = []
+
+            def submit_chunk():
+                nonlocal count, batch
+                while len(in_flight) >= MAX_CHUNKS_IN_FLIGHT_PER_SHARD:
+                    yield_chunk(ray.get(in_flight.popleft()))
+
+                chunk_name = os.path.join(shard_name, f"chunk-{count}")
+                count += 1
+                in_flight.append(produce_chunk.remote(batch, cache_dir, chunk_name))
+                batch = []
+
             for row in shard_iter:
                 batch.append(row)
                 if len(batch) == rows_per_chunk:
-                    # TODO: don't do a .get here, but spawn a whole bunch of tasks as soon as we can
-                    # the issue is we need to implement some kind of backpressure or latch-type thing so we don't starve
-                    # other shards since we want to stream them round-robin
-                    chunk_name = os.path.join(shard_name, f"chunk-{count}")
-                    count += 1
-                    chunk = ray.get(_produce_chunk.remote(batch, processor, cache_dir, chunk_name))
-                    yield_chunk(chunk)
-
-                    batch = []
+                    submit_chunk()
 
             if batch:
-                chunk_name = os.path.join(shard_name, f"chunk-{count}")
-                chunk = ray.get(_produce_chunk.remote(batch, processor, cache_dir, chunk_name))
-                yield_chunk(chunk)
+                submit_chunk()
+
+            while in_flight:
+                yield_chunk(ray.get(in_flight.popleft()))
 
             shard_metadata.is_finished = True
             _serialize_json_and_commit(os.path.join(cache_dir, f"{shard_name}.json"), shard_metadata)
@@ -221,6 +247,65 @@ def _produce_cache_for_shard(
         raise e
 
 
+def _in_process_cache_enabled() -> bool:
+    return os.getenv("LEVANTER_INPROC_CACHE", "0").lower() in ("1", "true")
+
+
+def _can_process_in_process(processor: BatchProcessor) -> bool:
+    return processor.num_gpus == 0 and not processor.resources
+
+
+def _ledger_exists(cache_dir: str) -> bool:
+    path = os.path.join(cache_dir, LEDGER_FILE_NAME)
+    fs = fsspec.core.url_to_fs(path)[0]
+    return fs.exists(path)
+
+
+def _read_small_source(source: ShardedDataSource[T], max_rows: int) -> Optional[Dict[str, List[T]]]:
+    """Reads every row of every shard, unless there are more than max_rows in total, in which case returns None.
+    Shards are read lazily, so for a big source we stop partway through the first shard."""
+    shard_rows: Dict[str, List[T]] = {}
+    total_rows = 0
+    for shard_name in source.shard_names:
+        rows = []
+        shard_iter = source.open_shard(shard_name)
+        try:
+            for row in shard_iter:
+                total_rows += 1
+                if total_rows > max_rows:
+                    return None
+                rows.append(row)
+        finally:
+            # release the shard's underlying file/connection if we stopped partway through
+            close = getattr(shard_iter, "close", None)
+            if close is not None:
+                close()
+        shard_rows[shard_name] = rows
+
+    return shard_rows
+
+
+def _build_cache_in_process(
+    cache_dir: str, shard_rows: Dict[str, List[T]], processor: BatchProcessor[T], rows_per_chunk: int
+):
+    """Synchronous version of the ray cache build, for sources small enough to hold in memory. Writes the same chunks,
+    shard metadata, and ledger (with the same round-robin chunk order) that the ray version does."""
+    shard_chunks: List[List[ChunkMetadata]] = []
+    for shard_name, rows in shard_rows.items():
+        shard_metadata = ShardMetadata()
+        for count, begin in enumerate(range(0, len(rows), rows_per_chunk)):
+            chunk_name = os.path.join(shard_name, f"chunk-{count}")
+            record_batch = processor(rows[begin : begin + rows_per_chunk])
+            shard_metadata.chunks.append(_write_chunk(record_batch, cache_dir, chunk_name))
+
+        shard_metadata.is_finished = True
+        _serialize_json_and_commit(os.path.join(cache_dir, f"{shard_name}.json"), shard_metadata)
+        shard_chunks.append(shard_metadata.chunks)
+
+    chunks = [chunk for chunks_in_round in itertools.zip_longest(*shard_chunks) for chunk in chunks_in_round if chunk]
+    _serialize_json_and_commit(os.path.join(cache_dir, LEDGER_FILE_NAME), CacheLedger(chunks))
+
+
 def _serialize_json_and_commit(path, obj):
     # just to be paranoid, we write to a temp file and then rename it
     # TODO: probably we could do better here
@@ -265,47 +350,64 @@ class RichMetricsMonitor(MetricsMonitor):
     progress: Optional[Progress]  # type: ignore
     task: Optional[TaskID]
 
-    def __init__(self, num_shards, **kwargs):
-        """kwargs are passed to rich.progress.Progress"""
+    def __init__(self, num_shards, progress: Optional[Progress] = None, description: str = "Shards", **kwargs):
+        """
+        :param progress: if given, the monitor adds a task to this (already started) Progress rather than starting
+        its own. Rich only allows one live display at a time, so this is how to monitor several caches at once.
+        :param kwargs: passed to rich.progress.Progress if we make our own
+        """
         self.kwargs = kwargs
-        self.progress: Optional[Progress] = None
+        self.progress = progress
+        self._owns_progress = progress is None
+        self.description = description
         self.task = None
         self.num_shards = num_shards
 
     def __call__(self, metrics: InProgressCacheMetrics):
-        if self.progress is None:
+        if self.task is None:
             self._init_progress(metrics)
 
         self.progress.update(self.task, completed=metrics.shards_finished, **dataclasses.asdict(metrics))  # type: ignore
 
         self.progress.refresh()  # type: ignore
 
-        if metrics.is_finished:
+        if metrics.is_finished and self._owns_progress:
             self.progress.stop()  # type: ignore
 
-    def _init_progress(self, metrics):
-        columns = [
+    @staticmethod
+    def make_progress(**kwargs) -> Progress:
+        """
+        Makes a Progress with the columns this monitor shows, e.g. to share one Progress among several monitors.
+        :param kwargs: passed to rich.progress.Progress
+        """
+        return Progress(
+            TextColumn("{task.description}"),
             BarColumn(),
             TaskProgressColumn(),
             TextColumn("| {task.fields[chunks_finished]} chunks", justify="center"),
             TextColumn("| {task.fields[rows_finished]} docs", justify="center"),
-        ]
-
-        for field in metrics.field_counts:
-            columns.append(TextColumn(f"| {{task.fields[field_counts][{field}]}} {field}", justify="center"))
-
-        columns.append(TimeElapsedColumn())
-        columns.append(TimeRemainingColumn())
-
-        self.progress = Progress(
-            *columns,
-            **self.kwargs,
+            _FieldCountsColumn(),
+            TimeElapsedColumn(),
+            TimeRemainingColumn(),
+            **kwargs,
         )
 
+    def _init_progress(self, metrics):
+        if self.progress is None:
+            self.progress = self.make_progress(**self.kwargs)
+            self.progress.start()
+
         self.task = self.progress.add_task(
-            "Shards", total=self.num_shards, completed=metrics.shards_finished, **dataclasses.asdict(metrics)
+            self.description, total=self.num_shards, completed=metrics.shards_finished, **dataclasses.asdict(metrics)
         )
-        self.progress.start()
+
+
+class _FieldCountsColumn(ProgressColumn):
+    """Shows each of a task's field_counts (e.g. the number of tokens), since they depend on the processor"""
+
+    def render(self, task) -> Text:
+        field_counts = task.fields.get("field_counts", {})
+        return Text(" ".join(f"| {count} {field}" for field, count in field_counts.items()), justify="center")
 
 
 class WandbMetricsMonitor(MetricsMonitor):
@@ -372,11 +474,15 @@ class ChunkCacheBuilder:
             logger.warning("No shards to index?!?")
             self._finish()
         else:
+            # put the source and processor (which can be big, e.g. a tokenizer) in the object store once, rather than
+            # serializing them into every shard's task
+            source_ref = ray.put(source)
+            processor_ref = ray.put(processor)
             for shard_name in source.shard_names:
                 self.buffered_shard_chunks[shard_name] = []
 
                 self.current_shard_tasks[shard_name] = _produce_cache_for_shard.remote(
-                    self_ref, source, shard_name, processor, cache_dir, rows_per_chunk
+                    self_ref, source_ref, shard_name, processor_ref, cache_dir, rows_per_chunk
                 )
 
     def new_chunk(self, shard_name: str, *chunks: ChunkMetadata):
@@ -691,6 +797,9 @@ class ShardCache(Iterable[pa.RecordBatch]):
                     raise e
 
     def await_finished(self, timeout: Optional[float] = None):
+        if self._broker is None:
+            # we loaded a finished ledger, so there's nothing to wait for
+            return None
         return ray.get(self.finished_sentinel(), timeout=timeout)
 
     def attach_metrics_monitor(self, monitor: MetricsMonitor):
@@ -21,6 +21,7 @@ from haliax.util import is_named_array
 from levanter.data import Dataset
 from levanter.data.dataset import ShardableDataset
 from levanter.shapes import NamedShapeSpec, ShapeSpec, to_raw_shape
+from levanter.utils.py_utils import background_iterator
 
 
 Ex = TypeVar("Ex")
@@ -202,6 +203,8 @@ class LocalBatchDataset(Dataset[Ex]):
 
     Note: this class discards remainder batches
 
+    Batches are assembled (read and stacked) on a background thread, up to `prefetch_buffer` batches ahead of the
+    consumer, so that loading the next batch overlaps with the training step. Set it to 0 to load synchronously.
     """
 
     def __init__(
@@ -210,17 +213,23 @@ class LocalBatchDataset(Dataset[Ex]):
         mesh: Mesh,
         Batch: hax.Axis,
         axis_resources: Optional[ResourceMapping] = None,
+        prefetch_buffer: int = 2,
     ):
         self.local_dataset = item_dataset
         self.mesh = mesh
         self.Batch = Batch
         self.axis_resources = axis_resources
+        self.prefetch_buffer = prefetch_buffer
 
     def __iter__(self):
+        # sharding stays on this thread: it depends on the (thread-local) axis mapping and mesh contexts
+        for stacked in background_iterator(self._stacked_batches(), self.prefetch_buffer):
+            yield self._shard(stacked)
+
+    def _stacked_batches(self):
         item_iter = iter(self.local_dataset)
         for batch in self._batched(item_iter):
-            stacked = jax.tree_map(lambda *leaves: self._stack_leaves(*leaves), *batch, is_leaf=is_named_array)
-            yield self._shard(stacked)
+            yield jax.tree_map(lambda *leaves: self._stack_leaves(*leaves), *batch, is_leaf=is_named_array)
 
     def _batched(self, item_iter):
         batch = []
@@ -228,6 +237,7 @@ class LocalBatchDataset(Dataset[Ex]):
             batch.append(item)
             if len(batch) == self.Batch.size:
                 yield batch
+                batch = []
 
     def _stack_leaves(self, *leaves):
         assert len(leaves) == self.Batch.size
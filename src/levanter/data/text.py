@@ -4,7 +4,6 @@ import logging
 import os
 from dataclasses import dataclass
 from functools import cached_property
-from itertools import chain
 from typing import Iterator, List, Optional, Sequence, Union
 
 import braceexpand
@@ -13,6 +12,7 @@ import fsspec
 import jax.numpy as jnp
 import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 from jaxtyping import PyTree
 from pyrallis import field
@@ -75,6 +75,10 @@ class TokenSeqDataset(ShardableDataset[NamedArray]):
         return TokenSeqDataset(self.doc_cache.shard(shard_id, num_shards), self.Pos, self.stride)
 
     def __iter__(self) -> Iterator[NamedArray]:
+        if self.stride is None:
+            yield from self._iter_non_overlapping()
+            return
+
         extra_tokens = None  # BatchEncoding of the last tokens from the previous doc
         for doc in self.doc_cache:
             # TODO: we could be cleverer here, and avoid these expensive copies etc
@@ -92,6 +96,29 @@ class TokenSeqDataset(ShardableDataset[NamedArray]):
                     ids = encoded_slice["input_ids"]
                     yield hax.named(ids, self.Pos)
 
+    def _iter_non_overlapping(self) -> Iterator[NamedArray]:
+        """Without a stride, the sequences are just consecutive windows of the concatenated token stream. So we reshape
+        each doc's tokens into windows, and only copy at the seams where a window straddles two docs."""
+        leftover: Optional[np.ndarray] = None  # the start of a window that the previous doc didn't finish
+        for doc in self.doc_cache:
+            for row in doc["input_ids"]:
+                row = np.asarray(row)
+                if leftover is not None:
+                    needed = self.seq_len - len(leftover)
+                    if len(row) < needed:
+                        leftover = np.concatenate([leftover, row])
+                        continue
+                    yield hax.named(np.concatenate([leftover, row[:needed]]), self.Pos)
+                    row = row[needed:]
+                    leftover = None
+
+                num_windows = len(row) // self.seq_len
+                for ids in row[: num_windows * self.seq_len].reshape(num_windows, self.seq_len):
+                    yield hax.named(ids, self.Pos)
+
+                if len(row) > num_windows * self.seq_len:
+                    leftover = row[num_windows * self.seq_len :]
+
     @property
     def item_shape(self) -> PyTree:
         return NamedShapeSpec((self.Pos,), jnp.int32)
@@ -155,12 +182,8 @@ class TokenizedDocumentCache(ShardableDataset[BatchEncoding]):
 
     def __len__(self):
         if self.flatten_docs:
-            return sum(
-                [
-                    len(_open_arrow_table(os.path.join(self.cache_dir, f"{c.name}.parquet")).to_batches())
-                    for c in self.chunks
-                ]
-            )
+            # one flattened doc per row group, which we can count from the parquet footers without reading any data
+            return sum(_num_row_groups(os.path.join(self.cache_dir, f"{c.name}.parquet")) for c in self.chunks)
         else:
             return sum(chunk.num_rows for chunk in self.chunks)
 
@@ -256,28 +279,81 @@ class TokenizedDocumentCache(ShardableDataset[BatchEncoding]):
         then the documents returned are actually concatenated documents, where the number is the number of documents
         presented as a batch to the caching process."""
         path = os.path.join(self.cache_dir, f"{chunk.name}.parquet")
-        for b in _open_arrow_table(path).to_batches():
+        for b in _iter_row_groups(path):
             if self.flatten_docs:
                 # insert a newaxis to the beginning so that it appears to be bs=1
                 yield BatchEncoding(
                     {
-                        b.field(i).name: b.column(i).values.to_numpy(zero_copy_only=False)[np.newaxis, :]
+                        b.field(i).name: _widen_ids(b.column(i).values.to_numpy(zero_copy_only=False))[np.newaxis, :]
                         for i in range(b.num_columns)
                     },
                     n_sequences=1,
                 )
             else:
                 yield BatchEncoding(
-                    {b.field(i).name: b.column(i).to_numpy(zero_copy_only=False) for i in range(b.num_columns)},
+                    {b.field(i).name: _ragged_rows(b.column(i)) for i in range(b.num_columns)},
                     n_sequences=b.num_rows,
                 )
 
 
+def _ragged_rows(column: Union[pa.Array, pa.ChunkedArray]) -> Union[List[np.ndarray], np.ndarray]:
+    """Splits a list column into one ndarray per row. Arrow already stores a list column as a single flat buffer
+    of values plus an offsets index, so we convert the values once and slice views out of them, rather than
+    materializing each row separately. Columns that aren't lists (e.g. one scalar per doc) are converted as is."""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if not (pa.types.is_list(column.type) or pa.types.is_large_list(column.type)):
+        return column.to_numpy(zero_copy_only=False)
+
+    values = _widen_ids(column.values.to_numpy(zero_copy_only=False))
+    offsets = column.offsets.to_numpy()
+    return [values[offsets[i] : offsets[i + 1]] for i in range(len(column))]
+
+
+def _narrow_id_type(values: pa.Array) -> pa.DataType:
+    """The smallest type we store a column of ids as. Most vocabularies (e.g. gpt2's) fit in uint16, which is a quarter
+    of the size of arrow's default int64, and anything else we've seen (big vocabs, -100 labels) fits in int32. Values
+    that don't fit in int32 keep their original type."""
+    min_max = pc.min_max(values)
+    lo, hi = min_max["min"].as_py(), min_max["max"].as_py()
+    if lo is None or (lo >= 0 and hi <= np.iinfo(np.uint16).max):
+        narrow = pa.uint16()
+    elif np.iinfo(np.int32).min <= lo and hi <= np.iinfo(np.int32).max:
+        narrow = pa.int32()
+    else:
+        return values.type
+
+    # don't "narrow" something that's already at least as small
+    return narrow if narrow.bit_width < values.type.bit_width else values.type
+
+
+def _widen_ids(values: np.ndarray) -> np.ndarray:
+    """Undoes _narrow_id_type: we always hand ids out as int32, regardless of how they were stored."""
+    if np.issubdtype(values.dtype, np.integer) and values.dtype.itemsize < 4:
+        return values.astype(np.int32)
+    return values
+
+
 def _open_arrow_table(path) -> pa.Table:
     fs, _, paths = fsspec.get_fs_token_paths(path)
     return pq.read_table(path, filesystem=fs)
 
 
+def _iter_row_groups(path) -> Iterator[pa.RecordBatch]:
+    """Reads a parquet file one row group at a time, as one record batch per row group. Unlike reading the whole
+    table, this only holds one row group in memory at a time."""
+    with fsspec.open(path, "rb") as f:
+        pf = pq.ParquetFile(f)
+        for i in range(pf.num_row_groups):
+            # a single row group, with its columns combined into single chunks, is a single record batch
+            yield from pf.read_row_group(i).combine_chunks().to_batches()
+
+
+def _num_row_groups(path) -> int:
+    with fsspec.open(path, "rb") as f:
+        return pq.ParquetFile(f).metadata.num_row_groups
+
+
 def _as_record_batch(doc: BatchEncoding) -> pa.RecordBatch:
     """Converts a document to an arrow-compatible record batch."""
 
@@ -288,7 +364,10 @@ def _as_record_batch(doc: BatchEncoding) -> pa.RecordBatch:
         elif isinstance(x, np.ndarray):
             return list(x)
         else:
-            return pa.array(x)
+            arr = pa.array(x)
+            if pa.types.is_list(arr.type) and pa.types.is_integer(arr.type.value_type):
+                arr = arr.cast(pa.list_(_narrow_id_type(arr.values)))
+            return arr
 
     names, columns = zip(*[(k, _as_array(v)) for k, v in doc.items()])
 
@@ -326,20 +405,55 @@ class BatchTokenizer(BatchProcessor[str]):
 
         self._need_to_add_eos = should_append_eos
 
+        # what an empty doc tokenizes to (usually nothing, but e.g. bert adds special tokens)
+        self._empty_doc_ids = list(tokenizer("")["input_ids"])
+
+        # newer versions of tokenizers have a batch encode that skips computing offsets, which we never use
+        self._use_encode_batch_fast = tokenizer.is_fast and hasattr(tokenizer.backend_tokenizer, "encode_batch_fast")
+
     def __call__(self, batch: Sequence[str]) -> pa.RecordBatch:
+        # batch is a whole chunk of docs, which we encode with one call so a fast tokenizer can spread it across
+        # its (Rust) threads. We only ever read input_ids from the cache, so we skip the mask and token type ids.
+        if not self._need_to_add_eos and not any(batch):
+            # a batch of nothing but empty docs (e.g. an empty shard) doesn't need the tokenizer at all
+            return _as_record_batch(BatchEncoding({"input_ids": [self._empty_doc_ids] * len(batch)}))
+
         if self._need_to_add_eos:
+            batch = [d + " " + self.tokenizer.eos_token for d in batch]
+
+        # hand the docs to the tokenizer longest first, so that its threads pick up the expensive docs early rather
+        # than finishing the batch on one long straggler. We put them back in their original order afterwards.
+        order = sorted(range(len(batch)), key=lambda i: len(batch[i]), reverse=True)
+        sorted_batch = [batch[i] for i in order]
+        if self._can_encode_batch_fast():
+            # call the rust tokenizer directly, rather than going through the python wrapper's BatchEncoding
+            encodings = self.tokenizer.backend_tokenizer.encode_batch_fast(sorted_batch)  # type: ignore
+            encoding = {"input_ids": [e.ids for e in encodings]}
+        else:
             encoding = self.tokenizer(
-                [d + " " + self.tokenizer.eos_token for d in batch], return_attention_mask=False, verbose=False
+                sorted_batch, return_attention_mask=False, return_token_type_ids=False, verbose=False  # type: ignore
             )
-        else:
-            encoding = self.tokenizer(batch, return_attention_mask=False, verbose=False)  # type: ignore
-        return _as_record_batch(encoding)
+        return _as_record_batch(BatchEncoding({k: _unpermute(v, order) for k, v in encoding.items()}))
+
+    def _can_encode_batch_fast(self) -> bool:
+        # calling the backend directly skips the wrapper resetting its truncation and padding, so we can only do it
+        # if neither is set (e.g. by a tokenizer.json, or by someone calling the tokenizer with truncation=True)
+        backend = self.tokenizer.backend_tokenizer if self._use_encode_batch_fast else None
+        return backend is not None and backend.truncation is None and backend.padding is None
 
     @property
     def num_cpus(self) -> int:
         return max(1, _cpu_count() - 2)
 
 
+def _unpermute(rows: Sequence, order: Sequence[int]) -> list:
+    """Inverse of `[x[i] for i in order]`"""
+    out = [None] * len(rows)
+    for sorted_i, original_i in enumerate(order):
+        out[original_i] = rows[sorted_i]
+    return out
+
+
 def concatenate_and_group_texts(
     encoding: BatchEncoding,
     seq_len: int,
@@ -362,7 +476,7 @@ def concatenate_and_group_texts(
     Returns:
         An iterator of tokenized texts, one at a time.
     """
-    concatenated = BatchEncoding(data={k: np.array(list(chain(*v))) for k, v in encoding.items()})
+    concatenated = BatchEncoding(data={k: _concatenate_rows(v) for k, v in encoding.items()})
     total_length = len(concatenated.input_ids)
     stride = stride or seq_len
 
@@ -384,6 +498,14 @@ def concatenate_and_group_texts(
         yield BatchEncoding(data=data)
 
 
+def _concatenate_rows(rows) -> np.ndarray:
+    """Concatenates a batch of token sequences into one flat array. The cache yields rows as ndarrays (often views into
+    one buffer), so we concatenate them directly rather than going through python ints."""
+    if len(rows) == 0:
+        return np.array([])
+    return np.concatenate([np.asarray(row) for row in rows])
+
+
 # -100 is pytorch's label mask
 def _mask_overlap(labels, target_len, stride, sentinel=-100):
     """Masks out overlapping tokens in a sequence when we're using a stride."""
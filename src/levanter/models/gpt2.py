@@ -1,3 +1,4 @@
+import math
 from dataclasses import dataclass
 from functools import partial
 from typing import Callable, Dict, Optional, cast
@@ -50,10 +51,32 @@ class Gpt2Config:
     upcast_attn: bool = False
 
     gradient_checkpointing: bool = True  # better to just always use this
-    gradient_checkpointing_block_size: int = 5
+    # checkpoint layers in groups of this size, storing only the group inputs. None means ceil(sqrt(num_layers))
+    gradient_checkpointing_block_size: Optional[int] = None
+    # name of a jax.checkpoint_policies policy for what to save within each layer. The default saves the outputs of
+    # the projection matmuls and recomputes the pointwise ops (and attention) on the backward pass.
+    # None recomputes the whole layer.
+    gradient_checkpointing_policy: Optional[str] = "dots_with_no_batch_dims_saveable"
+
+    # blockwise attention: never materializes the full [position, key_position] score matrix. Only used when
+    # attention dropout is off, since dropout needs the full attention weights.
+    use_flash_attention: bool = True
+    flash_attention_block_size: int = 128
 
     use_bias: bool = True
 
+    def flash_attention_enabled(self, inference: bool) -> bool:
+        return self.use_flash_attention and (inference or self.attn_pdrop == 0.0)
+
+    @property
+    def checkpoint_policy(self) -> Optional[Callable[..., bool]]:
+        if self.gradient_checkpointing_policy is None:
+            return None
+        policy = getattr(jax.checkpoint_policies, self.gradient_checkpointing_policy, None)
+        if policy is None:
+            raise ValueError(f"Unknown gradient checkpointing policy {self.gradient_checkpointing_policy}")
+        return policy
+
     # Axes
     Pos = property(lambda self: Axis(name="position", size=self.seq_len))
     KeyPos = property(lambda self: self.Pos.alias("key_position"))
@@ -110,17 +133,28 @@ class Gpt2Attention(StateDictSerializationMixin, eqx.Module):
 
     @named_call
     def __call__(self, x: NamedArray, mask: Optional[NamedArray], layer_idx, inference: bool = True, *, key):
+        # attention is always causal. With flash attention the causal mask is applied per key block, and `mask` is any
+        # additional boolean mask. Otherwise Gpt2Transformer has already ANDed the causal mask into `mask`, once for
+        # all layers.
+
+        # c_attn is a single [embed] -> [qkv, heads, head_size] matmul with the bias fused in. We keep the heads axis
+        # unflattened (rather than projecting to one flat 3 * heads * head_size axis) so it can still be sharded
+        # for tensor parallelism, and then split it with static slices
         qkv_out = self.c_attn(x)
         q, k, v = qkv_out.unbind("qkv")
 
-        # Rename k and v's Pos as haliax doesn't support unnamed axes or duplicate axes
-        k = k.rename({"position": "key_position"})
-        v = v.rename({"position": "key_position"})
+        # the config's axes are properties that make a new Axis each time, so look them up once
+        Pos, KeyPos, HeadSize = self.config.Pos, self.config.KeyPos, self.config.HeadSize
 
+        # Rename k and v's Pos as haliax doesn't support unnamed axes or duplicate axes. This only relabels the axes
+        # (no copy), and renaming to KeyPos directly skips the per-call size lookup
+        k, v = (t.rename({Pos: KeyPos}) for t in (k, v))
+
+        # a plain python float, so it's a constant folded into the q multiply rather than a traced rsqrt
+        scale = 1.0 / math.sqrt(HeadSize.size)
         # mistral tweak: scale norms by 1/sqrt(layer_idx) to prevent blowup
-        scale = jax.lax.rsqrt(float(self.config.HeadSize.size))
         if self.config.scale_attn_by_inverse_layer_idx:
-            scale /= layer_idx + 1.0
+            scale = scale / (layer_idx + 1.0)
 
         # do this first to help keep FP values small
         q = q * scale
@@ -130,15 +164,31 @@ class Gpt2Attention(StateDictSerializationMixin, eqx.Module):
             q = q.astype(jnp.float32)
             k = k.astype(jnp.float32)
 
-        attn_scores = hax.dot("head_size", q, k)
-
-        if mask is not None:
-            attn_scores = attn_scores + (1.0 - mask) * -1e9
-
-        attn_weights = hnn.softmax(attn_scores, axis="key_position").astype(x.dtype)
-        attn_weights = self.dropout(attn_weights, key=key, inference=inference)
-
-        attn_output = hax.dot("key_position", attn_weights, v)  # [heads, seq_len, head_dim]
+        if self.config.flash_attention_enabled(inference):
+            attn_output = hnn.attention.flash_attention(
+                Pos,
+                KeyPos,
+                HeadSize,
+                q,
+                k,
+                v,
+                mask=mask,
+                causal=True,
+                block_size=self.config.flash_attention_block_size,
+            ).astype(x.dtype)
+        else:
+            attn_scores = hax.dot("head_size", q, k)
+
+            # mask with a finite value (selected, which XLA fuses into the softmax) rather than softmax's where= with
+            # initial=-inf, which is 0/0 for a query that can't see any key. This way such a query gets the average of
+            # the values, the same as with flash attention
+            if mask is not None:
+                attn_scores = hax.where(mask, attn_scores, -1e9)
+            attn_weights = hnn.softmax(attn_scores, axis="key_position")
+            attn_weights = attn_weights.astype(x.dtype)
+            attn_weights = self.dropout(attn_weights, key=key, inference=inference)
+
+            attn_output = hax.dot("key_position", attn_weights, v)  # [heads, seq_len, head_dim]
 
         attn_output = self.c_proj(attn_output)
         return attn_output
@@ -197,7 +247,13 @@ class Gpt2Block(StateDictSerializationMixin, eqx.Module):
 
     @named_call
     def __call__(self, x: NamedArray, mask: Optional[NamedArray], layer_idx, inference, *, key):
-        k1, k2, k3 = haliax.jax_utils.maybe_rng_split(key, 3)
+        """
+        :param key: a stack of 3 PRNG keys (e.g. from shaped_rng_split(key, 3)), rather than a single key, or None.
+        Gpt2Transformer splits the keys for all of its layers up front and passes each block its row.
+        """
+        if key is not None and key.shape[:1] != (3,):
+            raise ValueError(f"Gpt2Block expects a stack of 3 PRNG keys (see shaped_rng_split), not shape {key.shape}")
+        k1, k2, k3 = (None, None, None) if key is None else (key[0], key[1], key[2])
 
         attn_output = self.attn(self.ln_1(x), mask=mask, inference=inference, layer_idx=layer_idx, key=k1)
         attn_output = self.resid_dropout(attn_output, key=k2, inference=inference)
@@ -217,8 +273,18 @@ class Gpt2Transformer(StateDictSerializationMixin, eqx.Module):
 
     @staticmethod
     def init(config: Gpt2Config, *, key):
+        checkpoint_block_size = config.gradient_checkpointing_block_size
+        if checkpoint_block_size is None:
+            checkpoint_block_size = math.ceil(math.sqrt(config.num_layers))
+
         # vectorize the blocks
-        blocks = Stacked.init(config.Layers, Gpt2Block, gradient_checkpointing=config.gradient_checkpointing)(
+        blocks = Stacked.init(
+            config.Layers,
+            Gpt2Block,
+            gradient_checkpointing=config.gradient_checkpointing,
+            checkpoint_block_size=checkpoint_block_size,
+            checkpoint_policy=config.checkpoint_policy,
+        )(
             config,
             key=shaped_rng_split(key, config.num_layers),
         )
@@ -228,8 +294,18 @@ class Gpt2Transformer(StateDictSerializationMixin, eqx.Module):
 
     @named_call
     def __call__(self, x: NamedArray, attn_mask: Optional[NamedArray], *, inference, key) -> NamedArray:
-        keys = hax.jax_utils.maybe_rng_split(key, self.config.num_layers) if key is not None else None
-        x = self.blocks.fold(x, attn_mask, hax.arange(self.config.Layers), inference, key=keys)
+        # split all the keys the blocks need at once, rather than splitting again inside every layer
+        keys = shaped_rng_split(key, (self.config.num_layers, 3)) if key is not None else None
+
+        if self.config.flash_attention_enabled(inference):
+            # flash attention generates the causal mask inside each key block, so we only pass the caller's mask
+            mask = attn_mask
+        else:
+            # build the full mask once here, rather than in every layer
+            causal_mask = hnn.attention.causal_mask(self.config.Pos, self.config.KeyPos)
+            mask = hnn.attention.combine_masks_and(causal_mask, attn_mask)
+
+        x = self.blocks.fold(x, mask, hax.arange(self.config.Layers), inference, key=keys)
         x = self.ln_f(x)
 
         return x
@@ -278,16 +354,23 @@ class Gpt2Embeddings(StateDictSerializationMixin, eqx.Module):
 
     @named_call
     def embed(self, input_ids, inference, *, key):
-        input_embeds = self.token_embeddings.take("vocab", input_ids)
-        position_embeds = self.position_embeddings
+        # token ids are always in range, so use a plain gather rather than paying for out-of-bounds handling
+        input_embeds = self.token_embeddings.take("vocab", input_ids, mode="clip")
+        # match the token embeddings' dtype, so a higher-precision table doesn't promote the residual stream
+        position_embeds = self.position_embeddings.astype(input_embeds.dtype)
 
         x = input_embeds + position_embeds
+        # (a no-op at trace time when embed_pdrop is 0 or we're in inference mode)
         x = self.dropout(x, inference=inference, key=key)
 
         return x
 
     def unembed(self, x: NamedArray):
-        return hax.dot("embed", x, self.token_embeddings)
+        # the output projection is tied to token_embeddings, so there's only ever one [vocab, embed] parameter (and
+        # one set of optimizer state for it). This is the largest matmul for small models with big vocabs, so run it
+        # in the activations' dtype (e.g. bf16) even if the embeddings are kept in f32. The cast is differentiable,
+        # so gradients still reach the f32 copy.
+        return hax.dot("embed", x, self.token_embeddings.astype(x.dtype))
 
     def _state_dict_key_map(self) -> Optional[Dict[str, Optional[str]]]:
         return {"token_embeddings": "wte.weight", "position_embeddings": "wpe.weight"}
@@ -322,6 +405,10 @@ class Gpt2LMHeadModel(StateDictSerializationMixin, eqx.Module):
         return Gpt2LMHeadModel(transformer, embeddings)
 
     def __call__(self, input_ids: NamedArray, attn_mask: Optional[NamedArray], *, inference, key):
+        """
+        :param attn_mask: optional boolean mask over (position, key_position), ANDed with the causal mask. The causal
+        mask is always applied, so there's no need to pass it in.
+        """
         if not inference and key is None:
             raise ValueError("key must be provided for training")
 
@@ -332,6 +419,22 @@ class Gpt2LMHeadModel(StateDictSerializationMixin, eqx.Module):
 
         return lm_logits
 
+    def quantize(self) -> "Gpt2LMHeadModel":
+        """
+        Returns a copy of this model with the attention and MLP projections quantized to int8 (with per-output-channel
+        scales), for inference. Layer norms, embeddings and the attention softmax are left in their original
+        precision. The quantized model can't be trained or converted back to a HF state dict.
+        """
+        block = self.transformer.blocks.stacked
+
+        def linears(block: Gpt2Block):
+            return block.attn.c_attn, block.attn.c_proj, block.mlp.c_fc, block.mlp.c_proj
+
+        quantized = tuple(hnn.QuantizedLinear.from_linear(linear) for linear in linears(block))
+        block = eqx.tree_at(linears, block, quantized)
+
+        return eqx.tree_at(lambda m: m.transformer.blocks.stacked, self, block)
+
     def _state_dict_key_map(self) -> Optional[Dict[str, Optional[str]]]:
         return {"transformer": None, "embeddings": None}
 
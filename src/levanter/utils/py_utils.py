@@ -1,4 +1,67 @@
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
+
+
+T = TypeVar("T")
+
+
 def non_caching_cycle(iterable):
     """Like itertools.cycle, but doesn't cache the iterable."""
     while True:
         yield from iterable
+
+
+_SENTINEL = object()
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def background_iterator(iterable: Iterable[T], max_capacity: int) -> Iterator[T]:
+    """
+    Produces items from `iterable` on a daemon thread, buffering up to `max_capacity` of them, so that producing the
+    next item overlaps with whatever the consumer does with the current one. Order is preserved, and exceptions raised
+    by the iterable are re-raised in the consumer. If max_capacity is 0, just iterates in the calling thread.
+    """
+    if max_capacity <= 0:
+        yield from iterable
+        return
+
+    q: queue.Queue = queue.Queue(maxsize=max_capacity)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        # poll so that we notice if the consumer went away and don't block forever on a full queue
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    return
+            _put(_SENTINEL)
+        except BaseException as e:
+            _put(_Failure(e))
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is _SENTINEL:
+                break
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
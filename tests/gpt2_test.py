@@ -1,11 +1,15 @@
 import dataclasses
 
+import equinox as eqx
+import jax
 import jax.numpy as jnp
+import pytest
 from jax.random import PRNGKey
 
 import haliax as hax
 from haliax import Axis
-from levanter.models.gpt2 import Gpt2Config, Gpt2LMHeadModel
+from haliax.jax_utils import shaped_rng_split
+from levanter.models.gpt2 import Gpt2Block, Gpt2Config, Gpt2LMHeadModel
 
 
 def test_gradient_checkpointing():
@@ -35,3 +39,81 @@ def test_gradient_checkpointing():
         a2 = model_checkpoint(input_ids, inference=False, key=key, attn_mask=causal_mask)
 
         assert hax.all(hax.isclose(a1, a2, rtol=1e-4, atol=1e-5)), f"failed with num_blocks={num_blocks}"
+
+
+def test_quantized_model_matches():
+    config = Gpt2Config(seq_len=16, hidden_dim=64, num_layers=2, num_heads=4)
+    Vocab = Axis("vocab", 128)
+    model = Gpt2LMHeadModel.init(Vocab, config, key=PRNGKey(0))
+    quantized = model.quantize()
+
+    assert quantized.transformer.blocks.stacked.mlp.c_fc.weight.dtype == jnp.int8
+
+    input_ids = hax.arange(config.Pos, dtype=jnp.int32)
+    causal_mask = hax.nn.attention.causal_mask(config.Pos, config.KeyPos)
+
+    a1 = model(input_ids, causal_mask, inference=True, key=None)
+    a2 = quantized(input_ids, causal_mask, inference=True, key=None)
+
+    assert hax.all(hax.isclose(a1, a2, rtol=1e-2, atol=1e-2))
+
+
+def test_causal_mask_is_implicit():
+    config = Gpt2Config(seq_len=16, hidden_dim=64, num_layers=2, num_heads=4, flash_attention_block_size=4)
+    Vocab = Axis("vocab", 128)
+    input_ids = hax.arange(config.Pos, dtype=jnp.int32)
+    causal_mask = hax.nn.attention.causal_mask(config.Pos, config.KeyPos)
+
+    for use_flash in [True, False]:
+        model = Gpt2LMHeadModel.init(Vocab, dataclasses.replace(config, use_flash_attention=use_flash), key=PRNGKey(0))
+
+        a1 = model(input_ids, causal_mask, inference=True, key=None)
+        a2 = model(input_ids, None, inference=True, key=None)
+
+        assert hax.all(hax.isclose(a1, a2, rtol=1e-4, atol=1e-5)), f"failed with use_flash={use_flash}"
+
+
+def test_fully_masked_rows_match_flash_attention():
+    config = Gpt2Config(seq_len=16, hidden_dim=64, num_layers=2, num_heads=4, flash_attention_block_size=4)
+    Vocab = Axis("vocab", 128)
+    input_ids = hax.arange(config.Pos, dtype=jnp.int32)
+    # position 5 can't attend to anything, not even itself
+    attn_mask = (hax.arange(config.Pos) != 5).broadcast_axis(config.KeyPos)
+
+    def loss(model):
+        return hax.sum(model(input_ids, attn_mask, inference=True, key=None)).scalar()
+
+    outputs = []
+    for use_flash in [True, False]:
+        model = Gpt2LMHeadModel.init(Vocab, dataclasses.replace(config, use_flash_attention=use_flash), key=PRNGKey(0))
+        out = model(input_ids, attn_mask, inference=True, key=None)
+        grads = jax.grad(loss)(model)
+
+        assert jnp.all(jnp.isfinite(out.array)), f"failed with use_flash={use_flash}"
+        leaves = jax.tree_util.tree_leaves(eqx.filter(grads, eqx.is_inexact_array))
+        assert all(jnp.all(jnp.isfinite(leaf)) for leaf in leaves), f"failed with use_flash={use_flash}"
+        outputs.append(out)
+
+    assert hax.all(hax.isclose(outputs[0], outputs[1], rtol=1e-4, atol=1e-5))
+
+
+def test_block_takes_a_stack_of_keys():
+    config = Gpt2Config(seq_len=16, hidden_dim=64, num_layers=1, num_heads=4, resid_pdrop=0.1)
+    block = Gpt2Block.init(config, key=PRNGKey(0))
+    x = hax.random.normal(PRNGKey(1), (config.Pos, config.Embed))
+
+    out = block(x, None, 0, inference=False, key=shaped_rng_split(PRNGKey(2), 3))
+    assert out.axes == x.axes
+
+    with pytest.raises(ValueError, match="stack of 3 PRNG keys"):
+        block(x, None, 0, inference=False, key=PRNGKey(2))
+
+
+def test_unembed_runs_in_activation_dtype():
+    config = Gpt2Config(seq_len=16, hidden_dim=64, num_layers=1, num_heads=4)
+    Vocab = Axis("vocab", 128)
+    model = Gpt2LMHeadModel.init(Vocab, config, key=PRNGKey(0))
+
+    x = hax.ones((config.Pos, config.Embed), dtype=jnp.bfloat16)
+    assert model.embeddings.token_embeddings.dtype == jnp.float32
+    assert model.embeddings.unembed(x).dtype == jnp.bfloat16
@@ -188,6 +188,20 @@ def test_split():
         assert jnp.all(jnp.equal(splits_str[i].array, usplits[i]))
 
 
+def test_unbind():
+    Height = Axis("Height", 2)
+    Width = Axis("Width", 3)
+    Depth = Axis("Depth", 4)
+
+    named1 = hax.random.uniform(PRNGKey(0), (Height, Width, Depth))
+
+    unbound = hax.unbind(named1, "Width")
+    assert len(unbound) == Width.size
+    for i, u in enumerate(unbound):
+        assert u.axes == (Height, Depth)
+        assert jnp.all(jnp.equal(u.array, named1.array[:, i, :]))
+
+
 def test_take():
     Height = Axis("Height", 2)
     Width = Axis("Width", 3)
@@ -384,3 +398,17 @@ def test_rename():
 
     assert jnp.all(jnp.equal(hax.rename(named1, {H: H2, "W": "W2"}).array, named1.array))
     assert hax.rename(named1, {H: H2, "W": "W2"}).axes == (H2, W2, D)
+
+
+def test_take_clip_mode():
+    H = Axis("H", 10)
+    W = Axis("W", 3)
+    Index = Axis("Index", 4)
+    named = hax.random.uniform(PRNGKey(0), (H, W))
+    index = hax.named(jnp.array([0, 9, 3, 3]), Index)
+
+    default = hax.take(named, "H", index)
+    clipped = hax.take(named, "H", index, mode="clip")
+
+    assert clipped.axes == (Index, W)
+    assert jnp.all(default.array == clipped.array)
@@ -1,9 +1,19 @@
+import jax
+import jax.numpy as jnp
+import jax.random as jrandom
 import numpy as np
 from jax.random import PRNGKey
 from test_utils import skip_if_no_torch
 
 import haliax as hax
-from haliax.nn.attention import alibi_attention_bias, dot_product_attention_weights, forgetful_causal_mask
+from haliax.nn.attention import (
+    alibi_attention_bias,
+    causal_mask,
+    dot_product_attention,
+    dot_product_attention_weights,
+    flash_attention,
+    forgetful_causal_mask,
+)
 
 
 def test_alibi_attention_bias():
@@ -68,3 +78,153 @@ def test_fcm_attention_mask():
 
     assert weights[mask == 0].sum() == 0
     assert weights[mask == 1].sum() > 0
+
+
+def test_flash_attention_matches_dot_product_attention():
+    QPos = hax.Axis("QPos", 16)
+    KPos = hax.Axis("KPos", 16)
+    Head = hax.Axis("Head", 2)
+    KeySize = hax.Axis("KeySize", 8)
+
+    k_q, k_k, k_v, k_m = jrandom.split(PRNGKey(0), 4)
+    query = hax.random.normal(k_q, (Head, QPos, KeySize))
+    key = hax.random.normal(k_k, (Head, KPos, KeySize))
+    value = hax.random.normal(k_v, (Head, KPos, KeySize))
+
+    fcm = forgetful_causal_mask(KPos, mask_prob=0.3, sample_prob=False, key=k_m)
+    mask = causal_mask(QPos, KPos) & fcm
+
+    expected = dot_product_attention(QPos, KPos, KeySize, query, key, value, mask=mask)
+    scaled_query = query / jnp.sqrt(KeySize.size)
+
+    # 5 and 6 don't divide 16, so the keys get padded
+    for block_size in [1, 4, 5, 6, 16, 32]:
+        actual = flash_attention(QPos, KPos, KeySize, scaled_query, key, value, mask=mask, block_size=block_size)
+        assert actual.axes == expected.axes
+        assert jnp.allclose(actual.array, expected.array, atol=1e-5)
+
+        # the causal mask can also be computed in the kernel itself
+        actual = flash_attention(
+            QPos, KPos, KeySize, scaled_query, key, value, mask=fcm, causal=True, block_size=block_size
+        )
+        assert jnp.allclose(actual.rearrange(expected.axes).array, expected.array, atol=1e-5)
+
+
+def test_flash_attention_with_fully_masked_rows():
+    QPos = hax.Axis("QPos", 7)
+    KPos = hax.Axis("KPos", 10)
+    Head = hax.Axis("Head", 2)
+    KeySize = hax.Axis("KeySize", 4)
+
+    k_q, k_k, k_v, k_m = jrandom.split(PRNGKey(0), 4)
+    query = hax.random.normal(k_q, (Head, QPos, KeySize))
+    key = hax.random.normal(k_k, (Head, KPos, KeySize))
+    value = hax.random.normal(k_v, (Head, KPos, KeySize))
+
+    # query 2 can't see any keys, so it should be the mean of the (unpadded) values, as in dot_product_attention
+    mask = hax.random.bernoulli(k_m, (QPos, KPos), 0.5) & (hax.arange(QPos) != 2).broadcast_axis(KPos)
+
+    expected = dot_product_attention(QPos, KPos, KeySize, query, key, value, mask=mask)
+    for block_size in [3, 4, 10]:
+        actual = flash_attention(
+            QPos, KPos, KeySize, query / jnp.sqrt(KeySize.size), key, value, mask=mask, block_size=block_size
+        )
+        assert jnp.allclose(actual.rearrange(expected.axes).array, expected.array, atol=1e-5)
+        assert jnp.allclose(actual.take(QPos, 2).array, hax.mean(value, axis=KPos).array, atol=1e-5)
+
+
+def test_flash_attention_gradients_and_residuals():
+    QPos = hax.Axis("QPos", 256)
+    KPos = hax.Axis("KPos", 256)
+    KeySize = hax.Axis("KeySize", 8)
+
+    k_q, k_k, k_v = jrandom.split(PRNGKey(0), 3)
+    query = hax.random.normal(k_q, (QPos, KeySize))
+    key = hax.random.normal(k_k, (KPos, KeySize))
+    value = hax.random.normal(k_v, (KPos, KeySize))
+    mask = causal_mask(QPos, KPos)
+
+    def flash(q, k, v):
+        return flash_attention(QPos, KPos, KeySize, q, k, v, causal=True, block_size=32).array
+
+    def dense(q, k, v):
+        return dot_product_attention(QPos, KPos, KeySize, q * jnp.sqrt(KeySize.size), k, v, mask=mask).array
+
+    def loss(attn):
+        return lambda q, k, v: jnp.sum(jnp.sin(attn(q, k, v)))
+
+    flash_grads = jax.grad(loss(flash), argnums=(0, 1, 2))(query, key, value)
+    dense_grads = jax.grad(loss(dense), argnums=(0, 1, 2))(query, key, value)
+    for actual, expected in zip(flash_grads, dense_grads):
+        assert jnp.allclose(actual.array, expected.array, atol=1e-4)
+
+    # the backward pass should save only q, k, v, the output, and the softmax max and denominator of each row, which
+    # is a small fraction of the (QPos, KPos) attention matrix
+    _, flash_vjp = jax.vjp(flash, query, key, value)
+    residual_size = sum(x.size for x in jax.tree_util.tree_leaves(flash_vjp))
+    assert residual_size <= 4 * QPos.size * KeySize.size + 2 * QPos.size
+    assert residual_size < QPos.size * KPos.size / 6
+
+
+def test_flash_attention_gradients_with_bias_and_mask():
+    QPos = hax.Axis("QPos", 11)
+    KPos = hax.Axis("KPos", 13)
+    Head = hax.Axis("Head", 3)
+    KeySize = hax.Axis("KeySize", 8)
+
+    k_q, k_k, k_v, k_b, k_m = jrandom.split(PRNGKey(1), 5)
+    query = hax.random.normal(k_q, (Head, QPos, KeySize))
+    key = hax.random.normal(k_k, (KPos, Head, KeySize))
+    value = hax.random.normal(k_v, (Head, KPos, KeySize))
+    # the bias is broadcast over QPos, so its gradient has to be summed over it
+    bias = hax.random.normal(k_b, (Head, KPos))
+    mask = hax.random.bernoulli(k_m, (QPos, KPos), 0.5) & (hax.arange(QPos) != 3).broadcast_axis(KPos)
+
+    def dense(q, k, v, b):
+        return dot_product_attention(QPos, KPos, KeySize, q * jnp.sqrt(KeySize.size), k, v, mask=mask, bias=b)
+
+    def loss(attn):
+        return lambda *args: hax.sum(hax.sin(attn(*args))).scalar()
+
+    dense_grads = jax.grad(loss(dense), argnums=(0, 1, 2, 3))(query, key, value, bias)
+
+    for block_size in [4, 5, 13]:
+
+        def flash(q, k, v, b):
+            return flash_attention(QPos, KPos, KeySize, q, k, v, mask=mask, bias=b, block_size=block_size)
+
+        flash_grads = jax.grad(loss(flash), argnums=(0, 1, 2, 3))(query, key, value, bias)
+        for actual, expected in zip(flash_grads, dense_grads):
+            assert actual.axes == expected.axes
+            assert jnp.allclose(actual.array, expected.array, atol=1e-5)
+
+
+def test_flash_attention_gradients_inside_fold():
+    # as in a Stacked transformer, where the attention is traced inside a scan
+    QPos = hax.Axis("QPos", 16)
+    KPos = hax.Axis("KPos", 16)
+    KeySize = hax.Axis("KeySize", 8)
+    Layer = hax.Axis("Layer", 2)
+
+    k_q, k_k, k_v = jrandom.split(PRNGKey(0), 3)
+    query = hax.random.normal(k_q, (QPos, KeySize))
+    key = hax.random.normal(k_k, (KPos, KeySize))
+    value = hax.random.normal(k_v, (KPos, KeySize))
+    mask = causal_mask(QPos, KPos)
+
+    def flash(q, k, v):
+        return flash_attention(QPos, KPos, KeySize, q, k, v, causal=True, block_size=4)
+
+    def dense(q, k, v):
+        return dot_product_attention(QPos, KPos, KeySize, q * jnp.sqrt(KeySize.size), k, v, mask=mask)
+
+    def loss(attn):
+        def layer(x, _, k, v):
+            return attn(x, k, v)
+
+        return lambda q, k, v: hax.sum(hax.fold(layer, Layer)(q, hax.arange(Layer), k, v)).scalar()
+
+    flash_grads = jax.grad(loss(flash), argnums=(0, 1, 2))(query, key, value)
+    dense_grads = jax.grad(loss(dense), argnums=(0, 1, 2))(query, key, value)
+    for actual, expected in zip(flash_grads, dense_grads):
+        assert jnp.allclose(actual.array, expected.array, atol=1e-4)
@@ -1,4 +1,5 @@
 import equinox as eqx
+import jax
 import jax.nn
 import jax.random as jrandom
 from jax import numpy as jnp
@@ -105,3 +106,109 @@ def test_standardize():
 
     assert actual.axes == (b, c)
     assert jnp.all(jnp.isclose(actual.array, expected))
+
+
+def test_stacked_nested_checkpointing():
+    class Module(eqx.Module):
+        named: hax.NamedArray
+        unnamed: jnp.ndarray
+
+        def __call__(self, x, y):
+            return x * self.named + y * hax.named(self.unnamed, ())
+
+        @staticmethod
+        def init(named, unnamed):
+            return Module(named=named, unnamed=unnamed)
+
+    Block = Axis("block", 6)
+    E = Axis("E", 10)
+
+    named = hax.random.uniform(jrandom.PRNGKey(0), (Block, E))
+    unnamed = jrandom.uniform(jrandom.PRNGKey(1), (Block.size,))
+    ys = hax.random.uniform(jrandom.PRNGKey(2), (Block,))
+    x = hax.random.uniform(jrandom.PRNGKey(3), (E,))
+
+    def loss(stacked, x):
+        return hax.sum(stacked.fold(x, ys)).scalar()
+
+    plain = hax.nn.Stacked.init(Block, Module)(named, unnamed)
+    expected = loss(plain, x)
+    expected_grad = jax.grad(loss)(plain, x)
+
+    # 4 doesn't divide 6, so this falls back to groups of 3
+    for block_size in [None, 1, 2, 3, 4, 6]:
+        stacked = hax.nn.Stacked.init(Block, Module, gradient_checkpointing=True, checkpoint_block_size=block_size)(
+            named, unnamed
+        )
+        assert jnp.allclose(loss(stacked, x), expected)
+
+        grad = jax.grad(loss)(stacked, x)
+        assert jnp.allclose(grad.stacked.named.array, expected_grad.stacked.named.array)
+        assert jnp.allclose(grad.stacked.unnamed, expected_grad.stacked.unnamed)
+
+
+def test_quantized_linear_matches_linear():
+    In = Axis("In", 64)
+    Out = Axis("Out", 32)
+    Batch = Axis("Batch", 8)
+    k_linear, k_x = jrandom.split(jrandom.PRNGKey(0))
+
+    linear = hax.nn.Linear.init(In, Out, key=k_linear)
+    linear = eqx.tree_at(lambda m: m.bias, linear, hax.random.normal(k_linear, (Out,)) * 0.1)
+    quantized = hax.nn.QuantizedLinear.from_linear(linear)
+
+    assert quantized.weight.dtype == jnp.int8
+    assert quantized.scale.axes == (Out,)
+
+    x = hax.random.normal(k_x, (Batch, In))
+    expected = linear(x)
+    actual = quantized(x)
+
+    assert actual.axes == expected.axes
+    assert jnp.allclose(actual.rearrange(expected.axes).array, expected.array, atol=2e-2)
+
+
+def test_softmax_with_named_where():
+    H = Axis("H", 4)
+    W = Axis("W", 8)
+    x = hax.random.normal(jrandom.PRNGKey(0), (H, W))
+    mask = hax.arange(W) < 5
+
+    out = hax.nn.softmax(x, axis=W, where=mask, initial=-jnp.inf)
+    expected = jax.nn.softmax(jnp.where(mask.array, x.array, -1e9), axis=1)
+
+    assert out.axes == (H, W)
+    assert jnp.allclose(out.array, expected, atol=1e-6)
+
+
+def test_stacked_fold_compiles_one_loop_body():
+    # the checkpointed fold should lower to a single scan whose body doesn't grow with the number of layers
+    E = Axis("E", 10)
+    E2 = E.alias("E2")
+
+    class Block(eqx.Module):
+        linear: hax.nn.Linear
+
+        def __call__(self, x):
+            return self.linear(x).rename({E2: E})
+
+        @staticmethod
+        def init(*, key):
+            return Block(hax.nn.Linear.init(In=E, Out=E2, key=key))
+
+    def num_eqns(num_layers):
+        Layers = Axis("layers", num_layers)
+        stacked = hax.nn.Stacked.init(
+            Layers,
+            Block,
+            gradient_checkpointing=True,
+            checkpoint_policy=jax.checkpoint_policies.dots_with_no_batch_dims_saveable,
+        )(key=jax.random.split(jrandom.PRNGKey(0), num_layers))
+
+        def loss(stacked, x):
+            return hax.sum(stacked.fold(x)).scalar()
+
+        jaxpr = jax.make_jaxpr(jax.grad(loss))(stacked, hax.ones(E))
+        return len(jaxpr.jaxpr.eqns)
+
+    assert num_eqns(2) == num_eqns(8)
@@ -165,3 +165,25 @@ def test_named_jit_works_without_axis_resources():
         r2 = pjit_foo2(hax.ones((Dim1, Dim2)))
 
         assert r2.array.sharding.is_equivalent_to(NamedSharding(mesh, PartitionSpec(None, ResourceAxis.DATA)), ndim=2)
+
+
+def test_named_jit_reuses_out_shardings():
+    from haliax.partitioning import _out_shardings_cache
+
+    mesh = Mesh(np.array(jax.devices()).reshape(-1, 1), (ResourceAxis.DATA, ResourceAxis.MODEL))
+    with axis_mapping(resource_map), mesh:
+
+        @named_jit
+        def double(x):
+            return x * 2
+
+        x = hax.ones((Dim1, Dim2))
+        num_cached = len(_out_shardings_cache)
+        out1 = double(x)
+        assert len(_out_shardings_cache) == num_cached + 1
+        out2 = double(x + 1)
+        assert len(_out_shardings_cache) == num_cached + 1
+
+        assert jnp.all(out1.array == 2)
+        assert jnp.all(out2.array == 4)
+        assert out1.array.sharding == out2.array.sharding
@@ -6,6 +6,7 @@ import jax
 import jax.numpy as jnp
 import jax.random as jrandom
 import numpy as onp
+import pytest
 from fsspec import AbstractFileSystem
 from jax.random import PRNGKey
 from test_utils import skip_if_no_torch
@@ -16,6 +17,7 @@ from transformers import GPT2LMHeadModel as HfGpt2LMHeadModel
 import haliax as hax
 from haliax import Axis
 from levanter.compat.hf_checkpoints import load_hf_gpt2_checkpoint, load_hf_model_checkpoint, save_hf_gpt2_checkpoint
+from levanter.compat.torch_serialization import stack_state_dict, unstack_state_dict
 from levanter.config import TrainerConfig
 from levanter.models.gpt2 import Gpt2Config, Gpt2LMHeadModel
 from levanter.models.loss import next_token_loss
@@ -189,3 +191,20 @@ def test_hf_save_to_fs_spec():
 
 
 # TODO: would be nice to have a test that tests hf upload?
+
+
+def test_stack_unstack_state_dict_roundtrip():
+    state_dict = {f"h.{i}.attn.weight": onp.full((2, 3), i, dtype=onp.float32) for i in range(4)}
+    state_dict["wte.weight"] = onp.zeros((5, 3))
+
+    stacked = stack_state_dict(state_dict, prefix="h")
+    assert stacked.keys() == {"h.attn.weight", "wte.weight"}
+    assert stacked["h.attn.weight"].shape == (4, 2, 3)
+
+    unstacked = unstack_state_dict({"h.attn.weight": jnp.asarray(stacked["h.attn.weight"])}, prefix="h")
+    for i in range(4):
+        assert onp.array_equal(unstacked[f"h.{i}.attn.weight"], state_dict[f"h.{i}.attn.weight"])
+
+    del state_dict["h.2.attn.weight"]
+    with pytest.raises(ValueError, match="Missing layers"):
+        stack_state_dict(state_dict, prefix="h")
@@ -34,8 +34,8 @@ def _small_dataset(seq_len=128, num_sequences=200) -> levanter.data.ShardableDat
         def item_shape(self) -> PyTree[Union[ShapeSpec, NamedShapeSpec]]:
             return ShapeSpec((seq_len,), dtype=np.int32)
 
-    # sequences = [list(range(i * 1000, i * 1000 + seq_len)) for i in range(num_sequences)]
-    sequences = [np.arange(seq_len) + 1000 * i for i in range(num_sequences)]
+    # row i is range(i * 1000, i * 1000 + seq_len)
+    sequences = np.arange(seq_len)[None, :] + 1000 * np.arange(num_sequences)[:, None]
 
     return SequenceDataset(sequences)
 
@@ -89,17 +89,20 @@ class StructuredDataset(levanter.data.ShardableDataset):
         self.begin = begin
         self.end = end
         self.stride = stride
+        self._base = np.arange(self.seq_len, dtype=np.int32)
+        self._base_mask = np.arange(self.seq_len * 2, dtype=np.int32).reshape(-1, 2)
 
     def __len__(self):
         return (self.end - self.begin) // self.stride
 
     def __getitem__(self, item):
+        ids = self._base + item * 1000
         return {
-            "input_ids": np.arange(self.seq_len, dtype=np.int32) + item * 1000,
-            "labels": np.arange(self.seq_len, dtype=np.int32) + item * 1000,
+            "input_ids": ids,
+            "labels": ids,
             "extra": {
-                "input_ids": np.arange(self.seq_len, dtype=np.int32) + item * 1000,
-                "mask": np.arange(self.seq_len * 2, dtype=np.int32).reshape(-1, 2) + item * 1000,
+                "input_ids": ids,
+                "mask": self._base_mask + item * 1000,
             },
         }
 
@@ -168,25 +171,23 @@ class StructuredDatasetWithNames(levanter.data.ShardableDataset):
         self.begin = begin
         self.end = end
         self.stride = stride
+        self._base_image = np.arange(Height.size * Width.size, dtype=np.int32).reshape(Height.size, Width.size)
+        self._base_mask = haliax.arange(Height)
 
     def __len__(self):
         return (self.end - self.begin) // self.stride
 
     def _gen_image(self, index):
-        image = (
-            np.arange(self.Height.size * self.Width.size, dtype=np.int32).reshape(self.Height.size, self.Width.size)
-            + index * 1000
-        )
-
-        return haliax.named(image, (self.Height, self.Width))
+        return haliax.named(self._base_image + index * 1000, (self.Height, self.Width))
 
     def __getitem__(self, item):
+        image = self._gen_image(item)
         return {
-            "input_ids": self._gen_image(item),
-            "labels": self._gen_image(item),
+            "input_ids": image,
+            "labels": image,
             "extra": {
-                "input_ids": self._gen_image(item),
-                "mask": haliax.arange(self.Height) + item * 1000,
+                "input_ids": image,
+                "mask": self._base_mask + item * 1000,
             },
         }
 
@@ -272,3 +273,20 @@ def test_structured_batches_model_axis_2_subsharded():
         batches = list(itertools.islice(dataset, 10))
         for batch in batches:
             check_sharded_consistency(batch, check_disjoint_indices_are_different=True)
+
+
+def test_prefetching_preserves_order():
+    devices = jax.devices()
+
+    mesh = Mesh(np.array(devices).reshape(-1, 1), (ResourceAxis.DATA, ResourceAxis.MODEL))
+    with mesh, haliax.axis_mapping({"batch": ResourceAxis.DATA}):
+        dataset = StructuredDataset(128, 0, 256, 1)
+        Batch = Axis("batch", len(devices))
+
+        prefetched = list(itertools.islice(LocalBatchDataset(dataset, mesh, Batch, prefetch_buffer=2), 10))
+        synchronous = list(itertools.islice(LocalBatchDataset(dataset, mesh, Batch, prefetch_buffer=0), 10))
+
+        assert len(prefetched) == len(synchronous) == 10
+        for a, b in zip(prefetched, synchronous):
+            assert np.array_equal(np.asarray(a["input_ids"]), np.asarray(b["input_ids"]))
+            assert np.array_equal(np.asarray(a["extra"]["mask"]), np.asarray(b["extra"]["mask"]))
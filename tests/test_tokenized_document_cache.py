@@ -1,6 +1,17 @@
+import contextlib
+import copy
+import functools
+import json
+import os
+import pathlib
+import shutil
 import tempfile
-from typing import List, Sequence, TypeVar
+from typing import Iterator, List, Sequence, TypeVar
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import pytest
 import ray
 
@@ -9,47 +20,111 @@ from test_utils import IdentityProcessor, ShardsDataSource, SingleShardDocumentS
 from transformers import AutoTokenizer, BatchEncoding
 
 from levanter.data.shard_cache import ShardedDataSource, cache_dataset
-from levanter.data.text import TokenizedDocumentCache, TokenSeqDataset
+from levanter.data.text import (
+    BatchTokenizer,
+    TokenizedDocumentCache,
+    TokenSeqDataset,
+    _as_record_batch,
+    _ragged_rows,
+)
+
 
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    # loaded lazily (and once), so collecting this module doesn't parse the tokenizer files
+    return AutoTokenizer.from_pretrained("gpt2", use_fast=True)
 
-tokenizer = AutoTokenizer.from_pretrained("gpt2")
 
 T = TypeVar("T")
 
 
+@pytest.fixture(autouse=True, scope="module")
+def in_process_cache():
+    # the caches in this module are tiny, so build them without ray (except where a test opts out)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("LEVANTER_INPROC_CACHE", "1")
+        yield
+
+
 def setup_module(module):
-    ray.init("local", num_cpus=10)
+    # buffer spilled objects so the cache build doesn't do lots of tiny writes on slow disks
+    spilling_config = {
+        "type": "filesystem",
+        "params": {"directory_path": os.path.join(tempfile.gettempdir(), "ray_spill"), "buffer_size": 1024 * 1024},
+    }
+    ray.init(
+        "local",
+        num_cpus=10,
+        _system_config={"object_spilling_config": json.dumps(spilling_config), "object_spilling_threshold": 0.8},
+    )
 
 
 def teardown_module(module):
     ray.shutdown()
 
 
-def test_index_empty_file():
-    with tempfile.TemporaryDirectory() as tmpdir:
-        empty_dataset = [""]
-        source = SingleShardDocumentSource(empty_dataset)
-        cache = TokenizedDocumentCache.build_or_load(
-            f"{tmpdir}/cache", source, tokenizer, flatten_docs=True, enforce_eos=False
-        )
+@contextlib.contextmanager
+def _ram_backed_tmpdir() -> Iterator[pathlib.Path]:
+    """A temporary directory in /dev/shm if we can use it (so the caches these tests write and read stay in memory),
+    or in the default temp dir otherwise"""
+    ram_root = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+    path = tempfile.mkdtemp(prefix="levanter-tests-", dir=ram_root)
+    try:
+        yield pathlib.Path(path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
 
-        for chunk in cache:
-            assert chunk["input_ids"].size == 0
 
+@pytest.fixture
+def cache_root():
+    with _ram_backed_tmpdir() as path:
+        yield path
+
+
+def test_index_empty_file(cache_root):
+    empty_dataset = [""]
+    source = SingleShardDocumentSource(empty_dataset)
+    cache = TokenizedDocumentCache.build_or_load(
+        f"{cache_root}/cache", source, get_tokenizer(), flatten_docs=True, enforce_eos=False
+    )
+
+    for chunk in cache:
+        assert chunk["input_ids"].size == 0
+
+
+def test_index_no_files(cache_root):
+    empty_dataset = []
+    source = SingleShardDocumentSource(empty_dataset)
+    cache = TokenizedDocumentCache.build_or_load(
+        f"{cache_root}/cache", source, get_tokenizer(), flatten_docs=True, enforce_eos=False
+    )
+
+    for chunk in cache:
+        pytest.fail("Should not have any chunks")
+
+
+def test_batch_tokenizer_matches_tokenizer():
+    tokenizer = get_tokenizer()
+    docs = ["hello", "a somewhat longer document than the others", "", "medium length doc"]
+    batch_tokenizer = BatchTokenizer(tokenizer, enforce_eos=False)
+    assert batch_tokenizer(docs).to_pydict()["input_ids"] == tokenizer(docs)["input_ids"]
+    # all empty docs are special cased
+    assert batch_tokenizer(["", ""]).to_pydict()["input_ids"] == tokenizer(["", ""])["input_ids"]
 
-def test_index_no_files():
-    with tempfile.TemporaryDirectory() as tmpdir:
-        empty_dataset = []
-        source = SingleShardDocumentSource(empty_dataset)
-        cache = TokenizedDocumentCache.build_or_load(
-            f"{tmpdir}/cache", source, tokenizer, flatten_docs=True, enforce_eos=False
-        )
 
-        for chunk in cache:
-            pytest.fail("Should not have any chunks")
+def test_batch_tokenizer_ignores_backend_truncation_and_padding():
+    tokenizer = copy.deepcopy(get_tokenizer())
+    docs = ["hello", "a somewhat longer document than the others", "medium length doc"]
+    batch_tokenizer = BatchTokenizer(tokenizer, enforce_eos=False)
 
+    # e.g. left over from someone else calling the tokenizer with truncation=True
+    tokenizer.backend_tokenizer.enable_truncation(2)
+    tokenizer.backend_tokenizer.enable_padding(length=16)
 
-def test_doc_cache_reproduces_data_one_batch_per_shard():
+    assert batch_tokenizer(docs).to_pydict()["input_ids"] == get_tokenizer()(docs)["input_ids"]
+
+
+def test_doc_cache_reproduces_data_one_batch_per_shard(cache_root):
     def doc_i(i: int):
         return BatchEncoding(data=dict(input_ids=[list(range(10 * i, 10 * (i + 1)))]))
 
@@ -72,54 +147,52 @@ def test_doc_cache_reproduces_data_one_batch_per_shard():
 
     source = OneDocPerShardSource(docs)
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        cache_dataset(f"{tmpdir}/cache", source, IdentityProcessor())
-        cache = TokenizedDocumentCache.load(f"{tmpdir}/cache", flatten_docs=False)
+    cache_dataset(f"{cache_root}/cache", source, IdentityProcessor())
+    cache = TokenizedDocumentCache.load(f"{cache_root}/cache", flatten_docs=False)
 
-        result = list(cache)
+    num_results = 0
+    for i, result in enumerate(cache):
+        assert i < num_docs
+        assert result["input_ids"][0].dtype == np.int32
+        assert _encodings_equal(result, docs[i])
+        num_results += 1
 
-        assert len(result) == num_docs
-        # sort the docs by input_ids b/c the order is not guaranteed
-        for i in range(len(result)):
-            as_listed = BatchEncoding(data={k: [vv.tolist() for vv in v] for k, v in result[i].items()})
-            assert as_listed == docs[i]
+    assert num_results == num_docs
 
 
 @pytest.mark.parametrize("batch_size", list(range(1, 10)))
-def test_doc_cache_reproduces_data_multi_docs_per_batch_sharded(batch_size):
-    def batch_docs(doc_ids):
-        return BatchEncoding(data=dict(input_ids=[list(range(10 * i, 10 * (i + 1))) for i in doc_ids]))
-
-    num_docs = 10
-    batches = [batch_docs([j, j + 1]) for j in range(0, num_docs, batch_size)]
+def test_doc_cache_reproduces_data_multi_docs_per_batch_sharded(cache_root, batch_size):
+    batches = [BatchEncoding(data=dict(input_ids=list(ids))) for ids in _multi_doc_batch_ids(batch_size)]
 
     source = ShardsDataSource([[b] for b in batches])
-    with tempfile.TemporaryDirectory() as tmpdir:
-        cache_dataset(f"{tmpdir}/cache", source, IdentityProcessor())
-        cache = TokenizedDocumentCache.load(f"{tmpdir}/cache", flatten_docs=True)
+    cache_dataset(f"{cache_root}/cache", source, IdentityProcessor())
+    cache = TokenizedDocumentCache.load(f"{cache_root}/cache", flatten_docs=True)
+
+    # all we can really assert is that every doc from docs is in the result as a sublist
+    found = [False] * len(batches)
+    num_results = 0
+    for result in cache:
+        num_results += 1
+        for i in range(len(batches)):
+            found[i] = found[i] or _contains(batches[i]["input_ids"][0], result["input_ids"][0])
 
-        result = list(cache)
+    assert num_results == len(batches)
+    assert all(found)
 
-        assert len(result) == len(batches)
 
-        def list_in_list(a, b):
-            """checks if a is a contiguous sublist of b"""
-            n = len(a)
-            return any((list(a) == list(b[i : i + n])) for i in range(len(b) - n + 1))
+@functools.lru_cache(maxsize=None)
+def _multi_doc_batch_ids(batch_size: int, num_docs: int = 10):
+    """input_ids for the batches in the multi-docs-per-batch test. Each batch has two (overlapping) docs"""
+    return tuple(
+        tuple(np.arange(10 * i, 10 * (i + 1), dtype=np.int32) for i in (j, j + 1))
+        for j in range(0, num_docs, batch_size)
+    )
 
-        # all we can really assert is that every doc from docs is in the result as a sublist
-        for i in range(len(batches)):
-            doc_tokens = batches[i]["input_ids"][0]
-            found = False
-            for j in range(len(result)):
-                # check if the doc is in this result doc
-                found = list_in_list(doc_tokens, result[j]["input_ids"][0])
-                if found:
-                    break
-            assert found
 
+def test_doc_cache_sharding(cache_root, monkeypatch):
+    # unlike the rest of this module, build this cache with ray, so the ray builder is covered here too
+    monkeypatch.setenv("LEVANTER_INPROC_CACHE", "0")
 
-def test_doc_cache_sharding():
     def doc_i(i: int):
         return BatchEncoding(data=dict(input_ids=[list(range(10 * i, 10 * (i + 1)))]))
 
@@ -129,29 +202,125 @@ def test_doc_cache_sharding():
     # group into num_shards groups
     doc_shards = [docs[i : i + num_docs // num_shards] for i in range(0, num_docs, num_docs // num_shards)]
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        source = ShardsDataSource(doc_shards)
-        cache_dataset(f"{tmpdir}/cache", source, IdentityProcessor())
+    source = ShardsDataSource(doc_shards)
+    cache_dataset(f"{cache_root}/cache", source, IdentityProcessor())
 
-        # must evenly divide num_shards
-        num_shards_rebuild = [1, 2, 3, 4, 6, 12]
+    # must evenly divide num_shards
+    num_shards_rebuild = [1, 2, 3, 4, 6, 12]
 
-        for open_shards in num_shards_rebuild:
-            cache = TokenizedDocumentCache.load(f"{tmpdir}/cache", flatten_docs=False)
-            reconstructed = []
+    for open_shards in num_shards_rebuild:
+        cache = TokenizedDocumentCache.load(f"{cache_root}/cache", flatten_docs=False)
+        reconstructed = []
 
-            for shard_idx in range(0, open_shards):
-                # now we shard the cache
-                c = cache.shard(shard_idx, open_shards)
-                reconstructed.extend([d for b in c for d in _unbatch_encoding(b)])
+        for shard_idx in range(0, open_shards):
+            # now we shard the cache
+            c = cache.shard(shard_idx, open_shards)
+            reconstructed.extend([d for b in c for d in _unbatch_encoding(b)])
 
-            assert len(reconstructed) == num_docs
+        assert len(reconstructed) == num_docs
 
-            # sort the docs by input_ids b/c the order is not guaranteed
-            reconstructed.sort(key=lambda x: x["input_ids"][0][0])  # extra [0] for batchiness
-            for i in range(len(reconstructed)):
-                as_listed = BatchEncoding(data={k: [vv.tolist() for vv in v] for k, v in reconstructed[i].items()})
-                assert as_listed == docs[i]
+        # sort the docs by input_ids b/c the order is not guaranteed
+        reconstructed.sort(key=lambda x: x["input_ids"][0][0])  # extra [0] for batchiness
+        np.testing.assert_array_equal(
+            np.stack([r["input_ids"][0] for r in reconstructed]), np.stack([d["input_ids"][0] for d in docs])
+        )
+
+
+def test_as_record_batch_narrows_ids():
+    batch = _as_record_batch(
+        BatchEncoding(data=dict(input_ids=[[0, 50256], [7]], labels=[[-100, 5], [1]], big=[[2**40], [1]]))
+    )
+
+    assert batch.schema.field("input_ids").type == pa.list_(pa.uint16())
+    assert batch.schema.field("labels").type == pa.list_(pa.int32())
+    # doesn't fit in int32, so it stays as it was
+    assert batch.schema.field("big").type == pa.list_(pa.int64())
+    assert batch.to_pydict() == {"input_ids": [[0, 50256], [7]], "labels": [[-100, 5], [1]], "big": [[2**40], [1]]}
+
+
+def test_doc_cache_mixes_narrow_and_wide_chunks(cache_root):
+    docs = [
+        BatchEncoding(data=dict(input_ids=[[1, 2, 3]])),
+        BatchEncoding(data=dict(input_ids=[[-100, 70000]])),
+    ]
+    # one shard each, so each doc gets its own chunk
+    cache_dataset(f"{cache_root}/cache", ShardsDataSource([[doc] for doc in docs]), IdentityProcessor())
+    cache = TokenizedDocumentCache.load(f"{cache_root}/cache", flatten_docs=False)
+
+    on_disk_types = [
+        pq.read_schema(f"{cache_root}/cache/{chunk.name}.parquet").field("input_ids").type for chunk in cache.chunks
+    ]
+    assert on_disk_types == [pa.list_(pa.uint16()), pa.list_(pa.int32())]
+
+    num_results = 0
+    for result, doc in zip(cache, docs):
+        # either way, ids come back as int32
+        assert result["input_ids"][0].dtype == np.int32
+        assert _encodings_equal(result, doc)
+        num_results += 1
+
+    assert num_results == len(docs)
+
+
+class _DocLengthProcessor(IdentityProcessor):
+    """Also stores each doc's length, as a scalar column"""
+
+    def __call__(self, batch: Sequence[BatchEncoding]) -> pa.RecordBatch:
+        record_batch = super().__call__(batch)
+        lengths = pc.list_value_length(record_batch.column(record_batch.schema.get_field_index("input_ids")))
+        return pa.RecordBatch.from_arrays(record_batch.columns + [lengths], record_batch.schema.names + ["length"])
+
+
+def test_doc_cache_reproduces_scalar_fields(cache_root):
+    docs = [BatchEncoding(data=dict(input_ids=[ids])) for ids in [[1, 2, 3], [4], [5, 6]]]
+    cache_dataset(f"{cache_root}/cache", SingleShardDocumentSource(docs), _DocLengthProcessor())
+    cache = TokenizedDocumentCache.load(f"{cache_root}/cache", flatten_docs=False)
+
+    input_ids = [list(ids) for result in cache for ids in result["input_ids"]]
+    lengths = [length for result in cache for length in result["length"]]
+    assert input_ids == [[1, 2, 3], [4], [5, 6]]
+    assert lengths == [3, 1, 2]
+
+
+def test_ragged_rows_handles_other_column_types():
+    expected = [[1, 2], [], [3]]
+
+    for column in [
+        pa.array(expected, type=pa.list_(pa.uint16())),
+        pa.array(expected, type=pa.large_list(pa.int64())),
+        pa.chunked_array(
+            [pa.array(expected[:2], type=pa.list_(pa.int32())), pa.array(expected[2:], pa.list_(pa.int32()))]
+        ),
+        # a slice's values are the whole buffer, but its offsets still point at the right rows
+        pa.array([[9]] + expected, type=pa.list_(pa.int32())).slice(1),
+    ]:
+        assert [list(row) for row in _ragged_rows(column)] == expected
+
+    np.testing.assert_array_equal(_ragged_rows(pa.array([3, 1, 2])), [3, 1, 2])
+    np.testing.assert_array_equal(_ragged_rows(pa.chunked_array([pa.array([3]), pa.array([1, 2])])), [3, 1, 2])
+
+
+@pytest.fixture(scope="module")
+def token_seq_cache():
+    """Builds (at most once per module) a cache of `num_docs` consecutive docs of length `doc_length`. The cache
+    doesn't depend on seq_len or flatten_docs, so the parametrizations below share them."""
+    built = {}
+
+    with _ram_backed_tmpdir() as root:
+
+        def build(num_docs: int, doc_length: int) -> str:
+            key = (num_docs, doc_length)
+            if key not in built:
+                docs = [
+                    BatchEncoding(data=dict(input_ids=[list(range(i * doc_length, (i + 1) * doc_length))]))
+                    for i in range(num_docs)
+                ]
+                path = str(root / f"cache_{num_docs}_{doc_length}")
+                cache_dataset(path, SingleShardDocumentSource(docs), IdentityProcessor())
+                built[key] = path
+            return built[key]
+
+        yield build
 
 
 @pytest.mark.parametrize("flatten_docs", [True, False])
@@ -159,27 +328,38 @@ def test_doc_cache_sharding():
     ["num_docs", "seq_len", "doc_length"],
     [(3, 10, 7), (3, 10, 1), (3, 10, 10), (1, 10, 10), (1, 10, 5), (1, 10, 1), (1, 10, 7), (3, 10, 20), (2, 10, 21)],
 )
-def test_token_seq_dataset_len_is_correct(flatten_docs, num_docs, seq_len, doc_length):
+def test_token_seq_dataset_len_is_correct(token_seq_cache, flatten_docs, num_docs, seq_len, doc_length):
     Pos = Axis("Pos", seq_len)
-    docs = [
-        BatchEncoding(data=dict(input_ids=[list(range(i * doc_length, (i + 1) * doc_length))]))
-        for i in range(num_docs)
-    ]
-    total_tokens_in_docs = sum([len(d["input_ids"][0]) for d in docs])
-    source = SingleShardDocumentSource(docs)
+    total_tokens_in_docs = num_docs * doc_length
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        cache_dataset(f"{tmpdir}/cache", source, IdentityProcessor())
-        cache = TokenizedDocumentCache.load(f"{tmpdir}/cache", flatten_docs=flatten_docs)
+    cache = TokenizedDocumentCache.load(token_seq_cache(num_docs, doc_length), flatten_docs=flatten_docs)
 
-        ds = TokenSeqDataset(cache, Pos)
-        assert len(ds) == (total_tokens_in_docs // seq_len)
-        all_examples = list(ds)
-        assert len(all_examples) == (total_tokens_in_docs // seq_len)
+    ds = TokenSeqDataset(cache, Pos)
+    assert len(ds) == (total_tokens_in_docs // seq_len)
+    all_examples = list(ds)
+    assert len(all_examples) == (total_tokens_in_docs // seq_len)
+    # the docs are consecutive ranges, so the concatenated stream is too
+    for i, example in enumerate(all_examples):
+        assert np.array_equal(np.asarray(example.array), np.arange(i * seq_len, (i + 1) * seq_len))
 
 
 def _unbatch_encoding(enc: BatchEncoding):
-    docs = []
-    for i in range(len(enc["input_ids"])):
-        docs.append(BatchEncoding(data={k: [v[i]] for k, v in enc.items()}))
-    return docs
+    # rows are ragged, so we can't stack them, but they're already views into one buffer, so just index them
+    columns = list(enc.items())
+    return [BatchEncoding(data={k: [v[i]] for k, v in columns}) for i in range(len(enc["input_ids"]))]
+
+
+def _encodings_equal(a: BatchEncoding, b: BatchEncoding):
+    """compares two single-doc encodings field by field as arrays"""
+    return a.keys() == b.keys() and all(np.array_equal(np.asarray(a[k][0]), np.asarray(b[k][0])) for k in a)
+
+
+def _contains(a, b):
+    """checks if a is a contiguous subsequence of b"""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if len(a) == 0:
+        return True
+    if len(b) < len(a):
+        return False
+    return bool((np.lib.stride_tricks.sliding_window_view(b, len(a)) == a).all(axis=1).any())